@@ -2,11 +2,20 @@ import os
 import sys
 import ctypes
 import time
-from llama_cpp import Llama, llama_log_set
+import signal
+import threading
+import contextlib
 
 from .input_manager import InputManager
 from .colors import Colors
-from .chat import Chat
+from .chat import Chat, Message
+from .prefill import SpeculativePrefill
+from .session_store import SessionStore
+from .autotune import AutoTuner, TUNED_PARAMS
+from .tools import Tool, ToolRegistry, ToolCallDetector
+from .cancellation import CancelToken
+from .memory import KV_CACHE_TYPES, n_ctx_for_budget, prewarm_file
+from .repetition import RepetitionDetector
 
 MODELS_DIR = "./models/"
 
@@ -18,13 +27,33 @@ class Agent:
     e fornire risposte incrementali o complete agli utenti.
     """
 
+    # Numero massimo di giri di chiamate a strumenti per ogni domanda dell'utente
+    MAX_TOOL_ROUNDS = 5
+
+    # Blocco di ragionamento vuoto con cui Qwen3 inizia le risposte in modalità /no_think
+    EMPTY_THINK = "<think>\n\n</think>\n\n"
+
     def __init__(self,
         name: str,
         n_ctx=2048,
         verbose=False,
         system_prompt: str = "Sei un assistente virtuale che risponde alle domande degli utenti.",
         n_generate: int = 1024,
-        temperature: float = 0.6
+        temperature: float = 0.6,
+        autotune: bool = False,
+        reply_timeout: float = None,
+        max_token_latency: float = None,
+        kv_cache_type: str = 'f16',
+        flash_attn: bool = False,
+        use_mmap: bool = None,
+        use_mlock: bool = None,
+        offload_kqv: bool = True,
+        n_gpu_layers: int = 0,
+        memory_budget_mb: int = None,
+        n_threads: int = None,
+        repetition: str = RepetitionDetector.STOP,
+        background_load: bool = False,
+        prewarm: bool = False
     ):
         """
         Inizializza un nuovo agente LLM.
@@ -35,32 +64,223 @@ class Agent:
         @param system_prompt: Prompt di sistema per inizializzare il comportamento dell'AI (default: messaggio in italiano)
         @param n_generate: Numero massimo di token da generare per risposta (default: 1024)
         @param temperature: Temperatura per la generazione di testo. Più è bassa più il modello tenderà a scegliere token con alta probabilità (default: 0.6)
+        @param autotune: Se True e non esiste un profilo salvato per questo host e modello, misura la configurazione migliore di thread, batch e mmap/mlock e la salva. Un profilo già salvato viene usato comunque (default: False)
+        @param reply_timeout: Tempo massimo in secondi per generare una risposta, None per nessun limite (default: None)
+        @param max_token_latency: Tempo massimo in secondi di attesa di un singolo token, None per nessun limite (default: None)
+        @param kv_cache_type: Tipo della cache KV: 'f32', 'f16', 'q8_0' o 'q4_0'. I tipi quantizzati richiedono flash attention, che viene attivata automaticamente (default: 'f16')
+        @param flash_attn: Se True, usa flash attention (default: False)
+        @param use_mmap: Se True, mappa in memoria i pesi del modello invece di copiarli, None per usare il profilo di auto-tuning o il default di llama.cpp (default: None)
+        @param use_mlock: Se True, blocca i pesi del modello in RAM impedendone lo swap, None per usare il profilo di auto-tuning o il default di llama.cpp (default: None)
+        @param offload_kqv: Se True, tiene la cache KV sulla GPU quando dei layer sono caricati sulla GPU (default: True)
+        @param n_gpu_layers: Numero di layer da caricare sulla GPU (default: 0)
+        @param memory_budget_mb: Memoria in MB per la cache KV: se indicata, n_ctx è il contesto più grande che ci sta (default: None)
+        @param n_threads: Numero di thread usati per la generazione e per la valutazione del prompt, None per usare il profilo di auto-tuning o il default di llama.cpp (default: None)
+        @param repetition: Cosa fare quando il modello ripete in loop lo stesso testo: 'stop' termina la risposta, 'penalty' penalizza i token che continuano la ripetizione, None non controlla le ripetizioni (default: 'stop')
+        @param background_load: Se True, il costruttore ritorna subito e il modello viene caricato in un thread in background: il primo uso del modello attende solo la parte di caricamento rimasta (default: False)
+        @param prewarm: Se True, prima di caricare il modello ne legge il file per portarlo in memoria ed evitare rallentamenti durante la prima risposta (default: False)
         """
-        if not verbose:
-            def my_log_callback(level, message, user_data): pass
-            log_callback = ctypes.CFUNCTYPE(None, ctypes.c_int, ctypes.c_char_p, ctypes.c_void_p)(my_log_callback)
-            llama_log_set(log_callback, ctypes.c_void_p())
-
         self.name = name
+        self.system_prompt = system_prompt
         self._prompt = ''
+
+        # Strumenti (funzioni Python) che il modello può chiamare
+        self.tools = ToolRegistry()
+        self._tool_detector = ToolCallDetector()
+        self._pending_tool_calls = []
+
+        # Messaggi da aggiungere al contesto prima del prossimo messaggio dell'utente
+        self._staged_messages: list[Message] = []
+
+        # Sessione persistente (vedi open_session)
+        self.sessions: SessionStore | None = None
+        self.session_id = None
+        self._kv_checkpoints = False
         
         # Inizializza tracking tokens/sec
         self.total_tokens_generated = 0
         self.total_generation_time = 0.0
         self.avg_tokens_per_sec = 0.0
+        self.expected_tokens_per_sec = None
+
+        # Limiti di tempo delle risposte (vedi _new_cancel_token)
+        self.reply_timeout = reply_timeout
+        self.max_token_latency = max_token_latency
+        self._cancel = None
         
-        InputManager.system_message("Caricamento del modello LLM...")
+        # Stato del caricamento del modello (vedi _load_model)
+        self._llm = None
+        self._chat = None
+        self._background_load = background_load
+        self._loaded = threading.Event()
+        self._load_error = None
+        self.load_phase = "Caricamento del modello LLM..."
+        self.load_progress = None
+
+        InputManager.system_message("Caricamento del modello LLM" + (" in background..." if background_load else "..."))
 
         # Verifica se il modello esiste
         self.model_path = os.path.join(MODELS_DIR, name + ".gguf")
         if not os.path.exists(self.model_path):
             raise FileNotFoundError(f"Il modello {self.model_path} non esiste.")
 
-        # Se esiste carica il modello LLM usando llama.cpp via llama-cpp-python
-        self.llm = Llama(model_path=self.model_path, n_ctx=n_ctx, verbose=verbose, seed=42)
-        self.chat = Chat(self.llm, n_generate=n_generate, temperature=temperature, top_p=0.95, top_k=20)
-        self.chat.send_message(Chat.SYSTEM_KEY, system_prompt)
-        InputManager.system_message("Modello caricato.")
+        if kv_cache_type not in KV_CACHE_TYPES:
+            raise ValueError(f"Tipo di cache KV non supportato: {kv_cache_type} (tipi supportati: {', '.join(KV_CACHE_TYPES)})")
+        kv_type = KV_CACHE_TYPES[kv_cache_type]
+        if kv_type not in (KV_CACHE_TYPES['f32'], KV_CACHE_TYPES['f16']) and not flash_attn:
+            InputManager.warn(f"La cache KV {kv_cache_type} richiede flash attention, che è stata attivata.")
+            flash_attn = True
+
+        # Deriva la dimensione del contesto dal budget di memoria della cache KV
+        if memory_budget_mb is not None:
+            n_ctx = n_ctx_for_budget(self.model_path, memory_budget_mb * 1024 * 1024, kv_type, kv_type)
+            InputManager.system_message(f"Contesto di {n_ctx} token per un budget di {memory_budget_mb} MB.")
+
+        llama_params = {
+            'n_ctx': n_ctx, 'verbose': verbose, 'seed': 42,
+            'type_k': kv_type, 'type_v': kv_type, 'flash_attn': flash_attn,
+            'offload_kqv': offload_kqv, 'n_gpu_layers': n_gpu_layers
+        }
+
+        # Le opzioni indicate esplicitamente prevalgono sul profilo di auto-tuning
+        overrides = {}
+        if n_threads is not None:
+            overrides.update({'n_threads': n_threads, 'n_threads_batch': n_threads})
+        if use_mmap is not None:
+            overrides['use_mmap'] = use_mmap
+        if use_mlock is not None:
+            overrides['use_mlock'] = use_mlock
+
+        chat_params = {
+            'n_generate': n_generate, 'temperature': temperature, 'top_p': 0.95, 'top_k': 20,
+            'repetition': RepetitionDetector(action=repetition) if repetition is not None else None
+        }
+
+        load_args = (llama_params, overrides, chat_params, autotune, prewarm)
+        if background_load:
+            threading.Thread(target=self._load_model, args=load_args, name='model-loader', daemon=True).start()
+        else:
+            self._load_model(*load_args)
+            self.wait_until_loaded()
+            InputManager.system_message("Modello caricato.")
+
+    @property
+    def llm(self):
+        """
+        Il modello llama.cpp (attende la fine del caricamento, se in corso).
+        """
+        self.wait_until_loaded()
+        return self._llm
+
+    @property
+    def chat(self) -> Chat:
+        """
+        La chat con il modello (attende la fine del caricamento, se in corso).
+        """
+        self.wait_until_loaded()
+        return self._chat
+
+    def is_loaded(self) -> bool:
+        """
+        Verifica se il caricamento del modello è terminato.
+
+        @return: True se il modello è pronto (o se il caricamento è fallito)
+        """
+        return self._loaded.is_set()
+
+    def wait_until_loaded(self):
+        """
+        Attende la fine del caricamento del modello mostrandone l'avanzamento.
+        Se il caricamento è fallito, ne solleva l'errore.
+        """
+        waited = not self._loaded.is_set()
+        while not self._loaded.wait(0.2):
+            progress = f" {self.load_progress:.0%}" if self.load_progress is not None else ""
+            print('\r\33[2K', end='')
+            InputManager.system_message(f"{self.load_phase}{progress}", new_line=False)
+        if waited:
+            print('\r\33[2K', end='')
+
+        if self._load_error is not None:
+            raise self._load_error
+        if waited:
+            InputManager.system_message("Modello caricato.")
+
+    def _load_model(self, llama_params: dict, overrides: dict, chat_params: dict, autotune: bool, prewarm: bool):
+        """
+        Carica il modello e crea la chat (nel thread di caricamento se il caricamento è in background).
+
+        @param llama_params: Parametri di llama.cpp
+        @param overrides: Parametri di llama.cpp indicati esplicitamente, che prevalgono sul profilo di auto-tuning
+        @param chat_params: Parametri della chat
+        @param autotune: Se True e non esiste un profilo salvato, esegue l'auto-tuning
+        @param prewarm: Se True, legge il file del modello prima di caricarlo
+        """
+        try:
+            self._set_load_phase("Importazione di llama.cpp...")
+            from llama_cpp import Llama, llama_log_set
+
+            if not llama_params['verbose']:
+                def my_log_callback(level, message, user_data): pass
+                self._log_callback = ctypes.CFUNCTYPE(None, ctypes.c_int, ctypes.c_char_p, ctypes.c_void_p)(my_log_callback)
+                llama_log_set(self._log_callback, ctypes.c_void_p())
+
+            # Usa il profilo di auto-tuning di questo host e modello, se presente (o se richiesto)
+            tuner = AutoTuner(self.model_path, n_ctx=llama_params['n_ctx'], verbose=llama_params['verbose'])
+            profile = tuner.load_profile()
+            if profile is None and autotune:
+                self._set_load_phase("Auto-tuning dei parametri del modello in corso...")
+                profile = tuner.tune(report=self._load_message)
+            if profile is not None:
+                llama_params.update({key: profile[key] for key in TUNED_PARAMS})
+                self.expected_tokens_per_sec = profile['generation_tokens_per_sec']
+                self._load_message(
+                    f"Profilo di auto-tuning: {profile['n_threads']} thread, {profile['n_threads_batch']} thread (batch), "
+                    f"batch {profile['n_batch']}, ~{profile['prompt_tokens_per_sec']:.0f} token/sec (prompt), "
+                    f"~{profile['generation_tokens_per_sec']:.1f} token/sec (generazione)"
+                )
+            llama_params.update(overrides)
+
+            # Porta il file del modello in memoria, così la prima risposta non attende le letture dal disco
+            if prewarm:
+                self._set_load_phase("Lettura del file del modello...", 0.0)
+                prewarm_file(self.model_path, progress=lambda fraction: self._set_load_phase("Lettura del file del modello...", fraction))
+
+            # Se esiste carica il modello LLM usando llama.cpp via llama-cpp-python
+            self._set_load_phase("Caricamento del modello LLM...")
+            self._llm = Llama(model_path=self.model_path, **llama_params)
+            self._chat = Chat(self._llm, **chat_params)
+            self._chat.send_message(Chat.SYSTEM_KEY, self.system_prompt)
+
+            # In background valuta anche il prompt di sistema, che fa parte di ogni richiesta
+            if self._background_load:
+                self._set_load_phase("Valutazione del prompt di sistema...")
+                self._chat.prefill()
+        except BaseException as e:
+            self._load_error = e
+        finally:
+            self._loaded.set()
+
+    def _set_load_phase(self, phase: str, progress: float = None):
+        """
+        Aggiorna la fase del caricamento del modello mostrata da wait_until_loaded.
+
+        @param phase: Descrizione della fase
+        @param progress: Frazione completata della fase, None se non nota (default: None)
+        """
+        self.load_phase = phase
+        self.load_progress = progress
+
+    def _load_message(self, text: str):
+        """
+        Mostra un messaggio del caricamento del modello; in background diventa la fase corrente,
+        così non si sovrappone all'input dell'utente.
+
+        @param text: Il messaggio
+        """
+        if self._background_load:
+            self._set_load_phase(text)
+        else:
+            InputManager.system_message(text)
     
     def complete_text(self, text: str):
         """
@@ -79,6 +299,131 @@ class Agent:
         print(f'{Colors.T_RESET}{Colors.T_BOLD_OFF}')
         
 
+    def ask_structured(self, prompt: str, schema: dict | type):
+        """
+        Invia un prompt all'LLM e restituisce la risposta come oggetto strutturato.
+
+        La risposta è vincolata da una grammatica ricavata dallo schema (una sola
+        volta per ogni schema) e viene validata mentre è generata. La generazione rispetta i limiti
+        di tempo dell'agente (reply_timeout, max_token_latency): se viene interrotta solleva StructuredOutputError.
+
+        @param prompt: Il testo del prompt da inviare al modello
+        @param schema: Uno schema JSON o una dataclass che descrive la risposta
+        @return: L'oggetto letto dalla risposta (un'istanza della dataclass se è stata passata una dataclass)
+        """
+        self._send_prompt_to_llm(prompt + ' /no_think')
+        value, self._remaining_ctx_tokens = self.chat.generate_structured_reply(schema, cancel=self._new_cancel_token())
+        self._save_session()
+        return value
+
+    def choose(self, prompt: str, choices: list[str]) -> str:
+        """
+        Chiede all'LLM di scegliere una tra più risposte possibili (classificazione, instradamento,
+        riconoscimento dell'intento...).
+
+        Invece di generare e interpretare una risposta, calcola la probabilità di ciascuna scelta
+        come risposta al prompt: il contesto viene valutato una sola volta e ogni scelta con un
+        singolo passaggio del modello. Il prompt e la scelta non vengono aggiunti alla conversazione.
+
+        @param prompt: La domanda a cui rispondere con una delle scelte
+        @param choices: Le risposte possibili
+        @return: La scelta più probabile
+        """
+        question = f"{prompt}\nRispondi solo con una di queste opzioni: {', '.join(choices)} /no_think"
+        context = self.chat.next_turn_tokens(Chat.ASSISTANT_KEY, self._staged_messages + [Message(Chat.USER_KEY, question)])
+        context += self.chat.tokenize_text(self.EMPTY_THINK)
+
+        index, _ = self.chat.choose(choices, context=context)
+        return choices[index]
+
+    def register_tool(self, func, name: str = None, description: str = None, parameters: dict = None, timeout: float = 30.0, ttl: float = 0.0) -> Tool:
+        """
+        Registra una funzione Python che il modello può chiamare durante le risposte.
+
+        Lo schema degli argomenti viene ricavato dalle annotazioni di tipo della funzione
+        e la descrizione dalla sua docstring, se non specificati. Il prompt di sistema viene
+        aggiornato con la descrizione degli strumenti disponibili.
+
+        @param func: La funzione da registrare
+        @param name: Nome dello strumento (default: nome della funzione)
+        @param description: Descrizione dello strumento (default: docstring della funzione)
+        @param parameters: Schema JSON degli argomenti (default: ricavato dalle annotazioni)
+        @param timeout: Tempo massimo di attesa del risultato in secondi (default: 30.0)
+        @param ttl: Secondi per cui il risultato viene riusato per gli stessi argomenti, 0 per disattivare la cache (default: 0.0)
+        @return: Lo strumento registrato
+        """
+        tool = self.tools.register(Tool(func, name=name, description=description, parameters=parameters, timeout=timeout, ttl=ttl))
+        self._update_system_prompt()
+        return tool
+
+    def ask_with_tools(self, prompt: str) -> str:
+        """
+        Invia un prompt all'LLM lasciandogli chiamare gli strumenti registrati.
+
+        Le chiamate vengono eseguite in parallelo e i risultati aggiunti al contesto come nuovi
+        turni, finché il modello non risponde senza chiamare strumenti (al massimo MAX_TOOL_ROUNDS volte).
+
+        @param prompt: Il testo del prompt da inviare al modello
+        @return: La risposta finale del modello (senza le chiamate a strumenti ignorate)
+        """
+        self._send_prompt_to_llm(prompt + ' /no_think')
+        for tool_round in range(self.MAX_TOOL_ROUNDS + 1):
+            self._generate_llm_response()
+            if not self._run_tool_calls(last_round=tool_round == self.MAX_TOOL_ROUNDS):
+                break
+        self._save_session()
+
+        return ToolCallDetector.strip(self._response)
+
+    def _update_system_prompt(self):
+        """
+        Aggiorna il primo messaggio di sistema con la descrizione degli strumenti registrati.
+
+        Il contesto viene ricostruito, quindi è meglio registrare gli strumenti prima di iniziare la conversazione.
+        """
+        for msg in self.chat.messages:
+            if msg.agent == self.chat.SYSTEM_KEY:
+                msg.content = self.system_prompt + self.tools.system_prompt()
+                break
+        self.chat.cache_rebuild()
+
+    def _detect_tool_calls(self, text: str):
+        """
+        Cerca chiamate a strumenti nel testo generato e le avvia subito in background.
+
+        @param text: Il nuovo testo generato dal modello
+        """
+        if len(self.tools) == 0:
+            return
+        for call in self._tool_detector.feed(text):
+            self._pending_tool_calls.append((call, self.tools.submit(call)))
+
+    def _run_tool_calls(self, last_round: bool = False) -> bool:
+        """
+        Attende i risultati delle chiamate a strumenti dell'ultima risposta e li aggiunge al contesto.
+
+        @param last_round: Se True il modello non può più rispondere ai risultati, quindi le chiamate vengono scartate
+        @return: True se sono stati chiamati strumenti (e il modello deve quindi continuare a rispondere)
+        """
+        calls = self._pending_tool_calls
+        self._pending_tool_calls = []
+        self._tool_detector = ToolCallDetector()
+        if not calls:
+            return False
+        if last_round:  # I risultati resterebbero nel contesto come un turno dell'utente senza risposta
+            for _, future in calls:
+                future.cancel()
+            InputManager.system_message(f"Limite di {self.MAX_TOOL_ROUNDS} turni con strumenti raggiunto, chiamate ignorate: {', '.join(call.name for call, _ in calls)}")
+            return False
+
+        InputManager.system_message(f"chiamata a: {', '.join(call.name for call, _ in calls)}")
+        results = self.tools.collect(calls)
+        # Le risposte degli strumenti sono un turno dell'utente (come nel template di Qwen):
+        # vengono solo aggiunte in coda al contesto, senza ricalcolare il prefisso già valutato
+        content = '\n'.join(f'<tool_response>\n{result}\n</tool_response>' for result in results)
+        self.chat.send_message(self.chat.USER_KEY, content)
+        return True
+
     def _get_name(self):
         """
         Restituisce il nome dell'agente formattato con colori.
@@ -93,9 +438,78 @@ class Agent:
 
         @param prompt: Il testo del prompt da inviare al modello
         """
+        for message in self._staged_messages:
+            self.chat.send_message(message.agent, message.content)
+        self._staged_messages = []
+
         self.chat.send_message(self.chat.USER_KEY, prompt)
         self._prompt = prompt
 
+    def open_session(self, session_id: str, sessions_dir: str = None, kv_checkpoints: bool = False) -> bool:
+        """
+        Apre una sessione persistente: se esiste già viene ripresa, altrimenti viene creata.
+
+        I messaggi e i token vengono salvati dopo ogni turno, quindi la ripresa non richiede di
+        ritokenizzare nulla. Con i checkpoint della cache KV non serve nemmeno rivalutare il contesto,
+        ma ogni checkpoint occupa spazio proporzionale ai token usati.
+
+        @param session_id: L'identificativo della sessione (lettere, cifre, '_', '-' e '.')
+        @param sessions_dir: La cartella delle sessioni (default: ./sessions/)
+        @param kv_checkpoints: Se True, salva la cache KV alla chiusura della sessione (default: False)
+        @return: True se la sessione è stata ripresa, False se è nuova
+        """
+        self.sessions = SessionStore(sessions_dir) if sessions_dir else SessionStore()
+        self.session_id = session_id
+        self._kv_checkpoints = kv_checkpoints
+
+        resumed = self.sessions.exists(session_id)
+        if resumed:
+            state = self.sessions.load(session_id)
+            self.chat.messages = state.messages
+            self.chat.tokens_cache = state.tokens
+            if state.checkpoint is not None:
+                self.chat.load_kv_state(*state.checkpoint)
+            InputManager.system_message(f"Sessione {session_id} ripresa ({len(state.messages)} messaggi, {len(state.tokens)} token).")
+        self._save_session()
+
+        return resumed
+
+    def close_session(self):
+        """
+        Chiude la sessione persistente, salvando un checkpoint della cache KV se richiesto
+        e compattando il log se contiene dati non più utili.
+        """
+        if self.sessions is None:
+            return
+
+        self._save_session()
+        if self._kv_checkpoints:
+            self.sessions.checkpoint(self.session_id, *self.chat.save_kv_state())
+        if self.sessions.load(self.session_id).n_garbage_records > 0:
+            self.sessions.compact(self.session_id)
+
+        self.sessions = None
+        self.session_id = None
+
+    def _save_session(self):
+        """
+        Aggiunge al log della sessione persistente (se aperta) i messaggi e i token non ancora salvati.
+        """
+        if self.sessions is not None:
+            self.sessions.sync(self.session_id, self.chat)
+
+    def stage_context(self, content: str, agent: str = Chat.SYSTEM_KEY):
+        """
+        Prepara un messaggio (ad esempio materiale recuperato o istruzioni di sistema) da aggiungere
+        al contesto prima del prossimo messaggio dell'utente.
+
+        Durante l'attesa dell'input il messaggio viene già valutato in background insieme al resto del contesto.
+
+        @param content: Il contenuto del messaggio
+        @param agent: L'agente del messaggio (default: sistema)
+        """
+        self._staged_messages.append(Message(agent=agent, content=content))
+
     def _show_llm_response(self, response=None):
         """
         Mostra la risposta dell'LLM nella console.
@@ -119,13 +533,56 @@ class Agent:
         if self.total_generation_time > 0:
             self.avg_tokens_per_sec = self.total_tokens_generated / self.total_generation_time
 
+    def _new_cancel_token(self) -> CancelToken:
+        """
+        Crea il token che può interrompere la prossima risposta, con i limiti di tempo dell'agente.
+
+        @return: Il token di cancellazione della risposta
+        """
+        self._cancel = CancelToken(timeout=self.reply_timeout, max_token_latency=self.max_token_latency)
+        return self._cancel
+
+    @contextlib.contextmanager
+    def _interruptible(self):
+        """
+        Durante il blocco, Ctrl-C interrompe solo la risposta in corso (che resta nel contesto)
+        invece di terminare l'intera conversazione.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        previous_handler = signal.signal(signal.SIGINT, lambda signum, frame: self._cancel.cancel('interrupted'))
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+
+    def _reply_was_cancelled(self) -> bool:
+        """
+        Controlla se l'ultima risposta è stata interrotta e in tal caso lo segnala all'utente.
+
+        Le chiamate a strumenti di una risposta interrotta vengono scartate.
+
+        @return: True se l'ultima risposta è stata interrotta
+        """
+        if self._cancel is None or not self._cancel.cancelled:
+            return False
+
+        reasons = {'interrupted': "dall'utente", 'timeout': 'per tempo scaduto', 'deadline': 'per tempo scaduto', 'latency': 'per latenza eccessiva'}
+        InputManager.system_message(f"Risposta interrotta {reasons.get(self._cancel.reason, '')}.")
+        self._pending_tool_calls = []
+        self._tool_detector = ToolCallDetector()
+        return True
+
     def _generate_llm_response(self):
         """
         Genera una risposta completa dall'LLM e la memorizza in self._response.
 
         Questo metodo genera l'intera risposta prima di restituirla.
         """
-        self._response, self._remaining_ctx_tokens = self.chat.generate_assistant_reply()
+        self._response, self._remaining_ctx_tokens = self.chat.generate_assistant_reply(cancel=self._new_cancel_token())
+        self._detect_tool_calls(self._response)
 
     def _generate_llm_response_incremental(self):
         """
@@ -145,8 +602,9 @@ class Agent:
         start_time = time.time()
         tokens_count = 0
         
-        for token in self.chat.generate_assistant_reply_stepped():
+        for token in self.chat.generate_assistant_reply_stepped(cancel=self._new_cancel_token()):
             tokens_count += 1
+            self._detect_tool_calls(token)
             
             if not in_think_check:
                 if token == "<think>" or token == "</think>":
@@ -176,7 +634,7 @@ class Agent:
         generation_time = time.time() - start_time
         self._update_tokens_per_sec(tokens_count, generation_time)
 
-    def start_conversation(self, incremental=True, forget=False):
+    def start_conversation(self, incremental=True, forget=False, prefill=True):
         """
         Avvia una conversazione interattiva con l'LLM.
 
@@ -188,9 +646,19 @@ class Agent:
         - 'clear': Cancella il contesto della conversazione
         - 'stats': Mostra statistiche sui token utilizzati
 
+        Durante una risposta, Ctrl-C interrompe solo la risposta: il testo generato fino a quel
+        momento resta nel contesto e la conversazione continua.
+
+        Se è stata aperta una sessione persistente (vedi open_session), ogni turno viene salvato
+        e la sessione viene chiusa al termine della conversazione.
+
         @param incremental: Se True, mostra le risposte token per token; se False, mostra la risposta completa (default: True)
         @param forget: Se True, resetta il contesto dopo ogni risposta (default: False)
+        @param prefill: Se True, mentre attende l'input valuta in background il contesto e l'intestazione del turno dell'utente (default: True)
         """
+        # Con il caricamento in background il prefill parte solo quando il modello è pronto
+        speculative_prefill = None
+
         InputManager.system_message("Puoi iniziare a conversare con l'LLM!")
         InputManager.system_message("Scrivi 'esci' per terminare.")
         InputManager.system_message("Scrivi 'stats' per vedere le statistiche.")
@@ -205,8 +673,18 @@ class Agent:
                 # Mostra il prompt e attendi l'input dell'utente
                 InputManager.show_user_prompt()
 
+                # Mentre l'utente scrive, il modello valuta quello che già conosce del prossimo prompt
+                if prefill and self.is_loaded() and self._load_error is None:
+                    speculative_prefill = speculative_prefill or SpeculativePrefill(self.chat)
+                    speculative_prefill.start(self.chat.next_turn_tokens(self.chat.USER_KEY, self._staged_messages))
+
                 # Use multiline input support
-                user_input = InputManager._get_multiline_input()
+                try:
+                    user_input = InputManager._get_multiline_input()
+                finally:
+                    # Il prefill va fermato prima di qualsiasi altro uso del modello (anche per 'clear' ed 'exit')
+                    if speculative_prefill is not None:
+                        speculative_prefill.stop()
                 
                 if not user_input.strip():
                     continue
@@ -218,6 +696,7 @@ class Agent:
 
                 if InputManager.is_clear_context_word(user_input):
                     self._reset_chat()
+                    self._save_session()
                     continue
 
                 if InputManager.is_stats_word(user_input):
@@ -228,19 +707,25 @@ class Agent:
                     user_input += ' /no_think'
                 self._send_prompt_to_llm(user_input)
 
-                if incremental:
-                    # Mostra la risposta dell'LLM in modo incrementale
-                    for response in self._generate_llm_response_incremental():
-                        print(response, end="", flush=True)
-                else:
-                    # Mostra l'intera risposta dell'LLM direttamente quando è completamente generata
-                    # Invia il prompt all'LLM e ricevi la risposta
-                    self._generate_llm_response()
-
-                    # Mostra la risposta dell'LLM
-                    self._show_llm_response()
+                # Se il modello chiama degli strumenti, ne riceve i risultati e continua a rispondere
+                for tool_round in range(self.MAX_TOOL_ROUNDS + 1):
+                    with self._interruptible():
+                        if incremental:
+                            # Mostra la risposta dell'LLM in modo incrementale
+                            for response in self._generate_llm_response_incremental():
+                                print(response, end="", flush=True)
+                        else:
+                            # Mostra l'intera risposta dell'LLM direttamente quando è completamente generata
+                            # Invia il prompt all'LLM e ricevi la risposta
+                            self._generate_llm_response()
+
+                            # Mostra la risposta dell'LLM
+                            self._show_llm_response()
+                    if self._reply_was_cancelled() or not self._run_tool_calls(last_round=tool_round == self.MAX_TOOL_ROUNDS):
+                        break
                 if forget:
                     self._reset_chat(silent=True)
+                self._save_session()
         except KeyboardInterrupt:
             print()
             InputManager.system_message("Conversazione terminata.")
@@ -250,6 +735,11 @@ class Agent:
                 InputManager.system_message("Conversazione terminata.")
             else:
                 InputManager.error(f"Si è verificato un errore: {e}")
+        finally:
+            # La fine della conversazione chiude anche la sessione persistente, se aperta,
+            # e annulla le chiamate a strumenti ancora in attesa
+            self.close_session()
+            self.tools.shutdown()
     
     def tokenize(self, text: str, show: bool = False) -> list[int]:
         """
@@ -335,7 +825,20 @@ class Agent:
         - Token utilizzati nella conversazione corrente
         - Token rimanenti nel contesto disponibile
         - Velocità media di generazione dei token
+        - Velocità attesa secondo il profilo di auto-tuning (se presente)
+        - Ripetizioni interrotte e token del budget delle risposte interrotte non usati (se il controllo delle ripetizioni è attivo)
+        - Memoria della cache KV (usata e allocata), di uno snapshot dello stato e del processo
         """
         InputManager.system_message(f"  token usati: {self.chat.tokens_used()}")
         InputManager.system_message(f"  token rimanenti: {self.chat.context_available()}")
         InputManager.system_message(f"  velocità media: {self.avg_tokens_per_sec:.0f} token/sec")
+        if self.expected_tokens_per_sec is not None:
+            InputManager.system_message(f"  velocità attesa: {self.expected_tokens_per_sec:.0f} token/sec")
+        if self.chat.repetition is not None:
+            InputManager.system_message(f"  ripetizioni interrotte: {self.chat.repetition.n_detections} (budget non usato: {self.chat.repetition.unused_budget} token)")
+
+        memory = self.chat.memory_report()
+        mb = 1024 * 1024
+        InputManager.system_message(f"  cache KV: {memory['kv_used_bytes'] / mb:.1f} MB usati su {memory['kv_allocated_bytes'] / mb:.1f} MB allocati")
+        InputManager.system_message(f"  snapshot dello stato: {memory['snapshot_bytes'] / mb:.1f} MB")
+        InputManager.system_message(f"  memoria del processo: {memory['rss_bytes'] / mb:.1f} MB")
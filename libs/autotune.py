@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import socket
+import multiprocessing
+from typing import Callable
+
+from .memory import drop_file_cache, prewarm_file
+
+PROFILES_PATH = "./models/autotune.json"
+
+# llama.cpp parameters chosen by the tuner and stored in the profile
+TUNED_PARAMS = ('n_threads', 'n_threads_batch', 'n_batch', 'n_ubatch', 'use_mmap', 'use_mlock')
+
+
+class AutoTuner:
+    """
+    Microbenchmark of the llama.cpp runtime parameters for a given (host, model file) pair.
+
+    The tuner measures prompt evaluation speed (which depends on `n_threads_batch` and `n_batch`),
+    generation speed (which depends on `n_threads`) and the time to load the model and evaluate a
+    first batch (which depends on `use_mmap` and `use_mlock`), then persists the best configuration
+    in a JSON file shared by all the models of the host.
+    """
+
+    BENCH_TEXT = "Il veloce gatto marrone salta sopra il cane pigro mentre il sole tramonta. "
+
+    def __init__(
+            self,
+            model_path: str,
+            n_ctx: int = 2048,
+            profiles_path: str = PROFILES_PATH,
+            prompt_tokens: int = 1024,
+            generate_tokens: int = 32,
+            verbose: bool = False
+    ) -> None:
+        """
+        Create a new AutoTuner object
+
+        @param model_path: the path of the GGUF model file
+        @param n_ctx: the context size used while benchmarking
+        @param profiles_path: the JSON file where the tuned profiles are stored
+        @param prompt_tokens: the number of tokens evaluated in the prompt benchmark (at least the largest batch size, at most `n_ctx`)
+        @param generate_tokens: the number of tokens decoded in the generation benchmark
+        @param verbose: whether or not llama.cpp should print its logs
+        """
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.profiles_path = profiles_path
+        # A prompt shorter than a batch would evaluate the same single batch with every batch size
+        self.prompt_tokens = min(max([prompt_tokens, *self.batch_candidates()]), n_ctx)
+        self.generate_tokens = generate_tokens
+        self.verbose = verbose
+
+
+    def profile_key(self) -> str:
+        """
+        Get the key that identifies the (host, model file) pair in the profiles file.
+        Size and modification time are included so that a replaced model is re-tuned.
+
+        @return: the profile key
+        """
+        stat = os.stat(self.model_path)
+        return f'{socket.gethostname()}|{os.path.abspath(self.model_path)}|{stat.st_size}|{int(stat.st_mtime)}'
+
+
+    def load_profile(self) -> dict | None:
+        """
+        Load the tuned profile of this (host, model file) pair, if any
+
+        @return: the profile or None if the pair was never tuned (or was tuned without some of the current parameters)
+        """
+        profile = self._read_profiles().get(self.profile_key())
+        if profile is None or any(key not in profile for key in TUNED_PARAMS):
+            return None
+
+        return profile
+
+
+    def save_profile(self, profile: dict) -> None:
+        """
+        Persist the profile of this (host, model file) pair, keeping the other ones
+
+        @param profile: the profile to save
+        """
+        profiles = self._read_profiles()
+        profiles[self.profile_key()] = profile
+
+        os.makedirs(os.path.dirname(self.profiles_path) or '.', exist_ok=True)
+        tmp_path = self.profiles_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(profiles, f, indent=2)
+        os.replace(tmp_path, self.profiles_path)
+
+
+    def tune(self, report: Callable[[str], None] | None = None) -> dict:
+        """
+        Run the benchmarks over all the candidates and save the best profile.
+
+        @param report: function called with a line of text for each measured setting
+        @return: the best profile, with the expected tokens/sec and all the measurements
+        """
+        report = report or (lambda text: None)
+        results = {'load': [], 'prompt': [], 'generation': []}
+
+        # Loading: mmap/mlock only affect the loading time and the initial page faults. The first eval is
+        # measured too (with mmap the weights are read on the first page faults) and every candidate starts
+        # from the same page cache: dropped where possible, otherwise filled
+        best_load = None
+        for use_mmap, use_mlock in self.memory_candidates():
+            if not drop_file_cache(self.model_path):
+                prewarm_file(self.model_path)
+            try:
+                start_time = time.perf_counter()
+                llm = self._load(use_mmap=use_mmap, use_mlock=use_mlock)
+                load_time = time.perf_counter() - start_time
+                llm.eval(self._bench_tokens(llm)[:self.generate_tokens])
+                eval_time = time.perf_counter() - start_time - load_time
+                llm.close()
+            except Exception as e:
+                report(f"  mmap={use_mmap} mlock={use_mlock}: non disponibile ({e})")
+                continue
+
+            results['load'].append({'use_mmap': use_mmap, 'use_mlock': use_mlock, 'load_seconds': load_time, 'first_eval_seconds': eval_time, 'seconds': load_time + eval_time})
+            report(f"  mmap={use_mmap} mlock={use_mlock}: caricamento in {load_time:.2f} s + prima valutazione in {eval_time:.2f} s")
+            if best_load is None or load_time + eval_time < best_load['seconds']:
+                best_load = results['load'][-1]
+
+        if best_load is None:
+            raise RuntimeError(f"Impossibile caricare il modello {self.model_path}.")
+        memory_params = {'use_mmap': best_load['use_mmap'], 'use_mlock': best_load['use_mlock']}
+
+        # Prompt eval: depends on n_batch (needs a new context, with the same physical batch size) and on n_threads_batch (does not)
+        best_prompt = None
+        for n_batch in self.batch_candidates():
+            llm = self._load(n_batch=n_batch, n_ubatch=n_batch, **memory_params)
+            prompt = self._bench_tokens(llm)
+            for n_threads_batch in self.thread_candidates():
+                llm._ctx.set_n_threads(n_threads=llm.n_threads, n_threads_batch=n_threads_batch)
+                tps = self._bench_prompt(llm, prompt)
+
+                results['prompt'].append({'n_batch': n_batch, 'n_threads_batch': n_threads_batch, 'tokens_per_sec': tps})
+                report(f"  n_batch={n_batch} n_threads_batch={n_threads_batch}: {tps:.0f} token/sec (prompt)")
+                if best_prompt is None or tps > best_prompt['tokens_per_sec']:
+                    best_prompt = results['prompt'][-1]
+            llm.close()
+
+        # Generation: one token at a time, depends only on n_threads
+        best_generation = None
+        llm = self._load(n_batch=best_prompt['n_batch'], n_ubatch=best_prompt['n_batch'], **memory_params)
+        prompt = self._bench_tokens(llm)
+        for n_threads in self.thread_candidates():
+            llm._ctx.set_n_threads(n_threads=n_threads, n_threads_batch=best_prompt['n_threads_batch'])
+            tps = self._bench_generation(llm, prompt)
+
+            results['generation'].append({'n_threads': n_threads, 'tokens_per_sec': tps})
+            report(f"  n_threads={n_threads}: {tps:.1f} token/sec (generazione)")
+            if best_generation is None or tps > best_generation['tokens_per_sec']:
+                best_generation = results['generation'][-1]
+        llm.close()
+
+        profile = {
+            'n_threads': best_generation['n_threads'],
+            'n_threads_batch': best_prompt['n_threads_batch'],
+            'n_batch': best_prompt['n_batch'],
+            'n_ubatch': best_prompt['n_batch'],
+            **memory_params,
+            'prompt_tokens_per_sec': best_prompt['tokens_per_sec'],
+            'generation_tokens_per_sec': best_generation['tokens_per_sec'],
+            'tuned_at': time.time(),
+            'results': results
+        }
+        self.save_profile(profile)
+
+        return profile
+
+
+    def get_or_tune(self, report: Callable[[str], None] | None = None) -> dict:
+        """
+        Get the saved profile of this (host, model file) pair or tune it if missing
+
+        @param report: function called with a line of text for each measured setting
+        @return: the profile
+        """
+        profile = self.load_profile()
+        if profile is None:
+            profile = self.tune(report=report)
+
+        return profile
+
+
+    @staticmethod
+    def available_cpus() -> int:
+        """
+        Get the number of CPUs this process is allowed to run on
+
+        @return: the number of usable CPUs
+        """
+        if hasattr(os, 'sched_getaffinity'):
+            return len(os.sched_getaffinity(0))
+        return multiprocessing.cpu_count()
+
+
+    def thread_candidates(self) -> list[int]:
+        """
+        Get the thread counts to benchmark
+
+        @return: the sorted list of thread counts
+        """
+        n_cpus = self.available_cpus()
+        return sorted({max(1, n_cpus * k // 4) for k in (1, 2, 3, 4)})
+
+
+    def batch_candidates(self) -> list[int]:
+        """
+        Get the batch sizes to benchmark
+
+        @return: the list of batch sizes that fit the context
+        """
+        return [n_batch for n_batch in (128, 256, 512, 1024) if n_batch <= self.n_ctx]
+
+
+    @staticmethod
+    def memory_candidates() -> list[tuple[bool, bool]]:
+        """
+        Get the (use_mmap, use_mlock) pairs to benchmark
+
+        @return: the list of pairs
+        """
+        return [(True, False), (True, True), (False, False)]
+
+
+    def _read_profiles(self) -> dict:
+        """
+        Read all the saved profiles
+
+        @return: the dict of profiles by profile key (empty if the file is missing or broken)
+        """
+        if not os.path.exists(self.profiles_path):
+            return {}
+        try:
+            with open(self.profiles_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+    def _load(self, **params):
+        """
+        Load the model with the given llama.cpp parameters
+
+        @return: the llama object
+        """
+        from llama_cpp import Llama
+
+        return Llama(model_path=self.model_path, n_ctx=self.n_ctx, verbose=self.verbose, seed=42, **params)
+
+
+    def _bench_tokens(self, llm) -> list[int]:
+        """
+        Build the prompt used by the benchmarks
+
+        @param llm: the llama object used to tokenize the prompt
+        @return: the prompt tokens
+        """
+        text = self.BENCH_TEXT * (self.prompt_tokens // 8 + 1)
+        return llm.tokenize(bytes(text, 'UTF-8'), add_bos=False, special=False)[:self.prompt_tokens]
+
+
+    @staticmethod
+    def _bench_prompt(llm, prompt: list[int]) -> float:
+        """
+        Measure the prompt evaluation speed, after an untimed batch that warms up the threads and the buffers
+
+        @param llm: the llama object
+        @param prompt: the tokens to evaluate in batches
+        @return: the evaluated tokens per second
+        """
+        llm.reset()
+        llm.eval(prompt[:llm.n_batch])
+        llm.reset()
+        start_time = time.perf_counter()
+        llm.eval(prompt)
+        return len(prompt) / (time.perf_counter() - start_time)
+
+
+    def _bench_generation(self, llm, prompt: list[int]) -> float:
+        """
+        Measure the generation speed by evaluating one token at a time, as the decoding does.
+        The content of the tokens does not affect the speed so no sampling is needed.
+
+        @param llm: the llama object
+        @param prompt: the tokens to evaluate
+        @return: the evaluated tokens per second
+        """
+        llm.reset()
+        n_prefix = len(prompt) // 2
+        llm.eval(prompt[:n_prefix - 1])
+        llm.eval(prompt[n_prefix - 1:n_prefix])  # Untimed warm-up with the current thread count
+        generated = prompt[n_prefix:n_prefix + self.generate_tokens]
+        start_time = time.perf_counter()
+        for token in generated:
+            llm.eval([token])
+        return len(generated) / (time.perf_counter() - start_time)
@@ -0,0 +1,407 @@
+import queue
+import random
+import threading
+from typing import Iterator
+
+import llama_cpp
+from llama_cpp import Llama, LlamaGrammar
+from llama_cpp._internals import LlamaBatch, LlamaContext, LlamaSampler
+
+from .chat import Chat
+from .cancellation import CancelToken
+
+
+class BatchedReply:
+    """
+    Handle of an assistant reply generated by a `BatchEngine`: iterate it to stream the reply
+    or call `result` to wait for the whole of it. The chat must not be used until the reply ends.
+    """
+
+    def __init__(self, chat: Chat, grammar: LlamaGrammar | None, cancel: CancelToken | None) -> None:
+        self.chat = chat
+        self.grammar = grammar
+        self.cancel = cancel
+        self.text = ''
+        self.n_tokens = 0
+
+        self._events = queue.Queue()
+        self._done = threading.Event()
+        self._error: Exception | None = None
+
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            kind, payload = self._events.get()
+            if kind == 'chunk':
+                yield payload
+            elif kind == 'error':
+                raise payload
+            else:
+                return
+
+
+    def result(self, timeout: float | None = None) -> str:
+        """
+        Wait for the end of the reply
+
+        @param timeout: the maximum number of seconds to wait
+        @return: the reply text, as committed to the chat
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError('The reply is not finished yet')
+        if self._error is not None:
+            raise self._error
+
+        return self.text
+
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+
+    def _emit(self, text: str) -> None:
+        self._events.put(('chunk', text))
+
+
+    def _finish(self, error: Exception | None = None) -> None:
+        self._error = error
+        self._events.put(('error', error) if error is not None else ('done', None))
+        self._done.set()
+
+
+class _Slot:
+    def __init__(self, seq_id: int) -> None:
+        self.seq_id = seq_id
+        self.tokens: list[int] = []     # Tokens of this sequence in the KV cache
+        self.busy = False
+
+
+class _Sequence:
+    def __init__(self, reply: BatchedReply, slot: _Slot, sampler: LlamaSampler, context_start: int, pending: list[int]) -> None:
+        self.reply = reply
+        self.slot = slot
+        self.sampler = sampler
+        self.context_start = context_start
+        self.pending = pending          # Tokens to evaluate before sampling the next one
+
+
+class BatchEngine:
+    """
+    Continuous batching of the assistant replies of many chats on the same model.
+
+    The engine owns a llama.cpp context (sharing the weights of the model) where every chat
+    being served is a separate sequence. At each step the next token of all the sequences
+    that are generating, and as many prompt tokens of the new sequences as fit, are evaluated
+    in a single decode; sequences join and leave the batch between steps. Each chat samples
+    with its own `temperature`, `top_p` and `top_k` and stops as `Chat.generate_assistant_reply`
+    (chats served at the same time need their own repetition detector, whose penalty is not applied).
+
+    Finished sequences keep their KV cache, so a chat that asks for its next reply only
+    evaluates its new tokens, and the longest common prefix of the cache (e.g. the system
+    prompt) is shared with new sequences instead of being evaluated again.
+    """
+
+    # Defaults of `Llama.generate`, which `Chat` doesn't override
+    MIN_P = 0.05
+    TYPICAL_P = 1.0
+
+    def __init__(
+            self,
+            model: Llama,
+            n_seq_max: int = 4,
+            n_ctx: int | None = None,
+            n_batch: int | None = None,
+            seed: int | None = None
+    ) -> None:
+        """
+        Create a new BatchEngine object and start its decoding thread
+
+        @param model: the model whose weights are used (its own context is not touched)
+        @param n_seq_max: the maximum number of sequences in a batch
+        @param n_ctx: the size of the KV cache shared by all the sequences (default: the model context for each sequence)
+        @param n_batch: the maximum number of tokens evaluated in a single step (default: the model batch size)
+        @param seed: the seed of the samplers (default: random)
+        """
+        self.model = model
+        self.n_seq_max = n_seq_max
+        self.n_batch = n_batch or model.n_batch
+        self._random = random.Random(seed)
+
+        params = llama_cpp.llama_context_params.from_buffer_copy(model.context_params)
+        params.n_ctx = n_ctx or model.n_ctx() * n_seq_max
+        params.n_batch = params.n_ubatch = self.n_batch
+        params.n_seq_max = n_seq_max
+        self._ctx = LlamaContext(model=model._model, params=params, verbose=model.verbose)
+        self._batch = LlamaBatch(n_tokens=self.n_batch, embd=0, n_seq_max=n_seq_max, verbose=model.verbose)
+
+        self._slots = [_Slot(seq_id) for seq_id in range(n_seq_max)]
+        self._active: list[_Sequence] = []
+        self._waiting: list[BatchedReply] = []
+        self._condition = threading.Condition()
+        self._running = True
+
+        self.n_steps = 0
+        self.n_evaluated = 0
+
+        self._thread = threading.Thread(target=self._run, name='batch-engine', daemon=True)
+        self._thread.start()
+
+
+    def submit(self, chat: Chat, grammar: LlamaGrammar | None = None, cancel: CancelToken | None = None) -> BatchedReply:
+        """
+        Queue the generation of an assistant reply (after a user message presumably)
+
+        @param chat: the chat to reply to, the reply is committed to it as `Chat.generate_assistant_reply` does
+        @param grammar: the grammar used to constrain the output of the model
+        @param cancel: the token that can stop the generation (the partial reply is committed or rolled back as it says)
+        @return: the handle of the reply
+        """
+        reply = BatchedReply(chat, grammar, cancel)
+        with self._condition:
+            if not self._running:
+                raise RuntimeError('The batch engine was shut down')
+            self._waiting.append(reply)
+            self._condition.notify()
+
+        return reply
+
+
+    def shutdown(self) -> None:
+        """
+        Stop the engine; the replies still in progress are cancelled and committed
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+
+    def __enter__(self) -> 'BatchEngine':
+        return self
+
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+
+
+    def _run(self) -> None:
+        """
+        Body of the decoding thread
+        """
+        while True:
+            with self._condition:
+                while self._running and not self._waiting and not self._active:
+                    self._condition.wait()
+                if not self._running:
+                    break
+                while self._waiting and any(not slot.busy for slot in self._slots):
+                    reply = self._waiting.pop(0)
+                    try:
+                        self._admit(reply)
+                    except Exception as e:
+                        reply._finish(e)
+
+            try:
+                self._step()
+            except Exception as e:
+                for sequence in list(self._active):
+                    self._retire(sequence, error=e)
+
+        for sequence in list(self._active):
+            sequence.reply.chat.interrupt_reply(sequence.reply.text, sequence.context_start)
+            self._retire(sequence)
+        for reply in self._waiting:
+            reply._finish(RuntimeError('The batch engine was shut down'))
+        self._ctx.close()
+        self._batch.close()
+
+
+    def _admit(self, reply: BatchedReply) -> None:
+        """
+        Start a sequence for a reply in the free slot whose cache shares the longest prefix with its prompt
+
+        @param reply: the reply to start
+        """
+        chat = reply.chat
+        context_start = len(chat.tokens_cache)
+        chat.cache_append_header(agent=Chat.ASSISTANT_KEY)
+        prompt = chat.tokens_cache
+        if reply.cancel is not None: reply.cancel.start()
+        if reply.grammar is None and chat.repetition is not None: chat.repetition.reset()
+
+        # The last token of the prompt is always evaluated, to get the logits of the first token of the reply
+        free = [slot for slot in self._slots if not slot.busy]
+        slot = max(free, key=lambda slot: Llama.longest_token_prefix(slot.tokens, prompt[:-1]))
+        n_past = Llama.longest_token_prefix(slot.tokens, prompt[:-1])
+
+        # Copy a longer shared prefix from another sequence instead of evaluating it again
+        source = max(self._slots, key=lambda other: Llama.longest_token_prefix(other.tokens, prompt[:-1]))
+        n_shared = Llama.longest_token_prefix(source.tokens, prompt[:-1])
+        if n_shared > n_past:
+            self._ctx.kv_cache_seq_rm(slot.seq_id, 0, -1)
+            self._ctx.kv_cache_seq_cp(source.seq_id, slot.seq_id, 0, n_shared)
+            slot.tokens = source.tokens[:n_shared]
+            n_past = n_shared
+        else:
+            self._ctx.kv_cache_seq_rm(slot.seq_id, n_past, -1)
+            slot.tokens = slot.tokens[:n_past]
+
+        slot.busy = True
+        self._active.append(_Sequence(reply, slot, self._sampler(chat, reply.grammar), context_start, prompt[n_past:]))
+
+
+    def _sampler(self, chat: Chat, grammar: LlamaGrammar | None) -> LlamaSampler:
+        """
+        Create the sampler chain of a sequence with the parameters of its chat. The chain is the one
+        built by `Llama.generate` (used by `Chat`) with its default min_p and typical_p, so that a chat
+        samples from the same distribution with or without the engine.
+
+        @param chat: the chat of the sequence
+        @param grammar: the grammar used to constrain the output of the model
+        @return: the sampler
+        """
+        sampler = LlamaSampler()
+        if grammar is not None:
+            sampler.add_grammar(self.model._model, grammar)
+        if chat.temperature <= 0:
+            sampler.add_greedy()
+            return sampler
+
+        sampler.add_top_k(chat.top_k)
+        sampler.add_typical(self.TYPICAL_P, 1)
+        sampler.add_top_p(chat.top_p, 1)
+        sampler.add_min_p(self.MIN_P, 1)
+        sampler.add_temp(chat.temperature)
+        sampler.add_dist(self._random.getrandbits(32))
+
+        return sampler
+
+
+    def _step(self) -> None:
+        """
+        Evaluate a batch made of the next token of the generating sequences followed by the
+        prompt chunks of the new ones that fit, then sample a token for every sequence that
+        finished its prompt
+        """
+        if not self._active:
+            return
+
+        # Generating sequences come first, so that new prompts don't slow down the running replies
+        planned = []
+        budget = self.n_batch
+        for sequence in sorted(self._active, key=lambda sequence: len(sequence.pending) > 1):
+            n_tokens = min(len(sequence.pending), budget)
+            if n_tokens == 0:
+                continue
+            planned.append((sequence, sequence.pending[:n_tokens]))
+            budget -= n_tokens
+
+        batch = self._batch.batch
+        batch.n_tokens = 0
+        logits_index = {}
+        for sequence, tokens in planned:
+            n_past = len(sequence.slot.tokens)
+            for i, token in enumerate(tokens):
+                j = batch.n_tokens
+                batch.token[j] = token
+                batch.pos[j] = n_past + i
+                batch.n_seq_id[j] = 1
+                batch.seq_id[j][0] = sequence.slot.seq_id
+                batch.logits[j] = False
+                batch.n_tokens += 1
+            if len(tokens) == len(sequence.pending):
+                batch.logits[batch.n_tokens - 1] = True
+                logits_index[sequence] = batch.n_tokens - 1
+
+        result = llama_cpp.llama_decode(self._ctx.ctx, batch)
+        if result == 1:  # No room in the KV cache
+            self._evict(planned)
+            return
+        if result != 0:
+            raise RuntimeError(f'llama_decode returned {result}')
+        self.n_steps += 1
+        self.n_evaluated += batch.n_tokens
+
+        for sequence, tokens in planned:
+            sequence.slot.tokens += tokens
+            sequence.pending = sequence.pending[len(tokens):]
+        for sequence, index in logits_index.items():
+            self._advance(sequence, sequence.sampler.sample(self._ctx, index))
+
+
+    def _advance(self, sequence: _Sequence, token: int) -> None:
+        """
+        Add a sampled token to the reply of a sequence, applying the same stop conditions as `Chat`
+
+        @param sequence: the sequence
+        @param token: the sampled token
+        """
+        reply = sequence.reply
+        chat = reply.chat
+
+        if reply.cancel is not None and reply.cancel.check():  # Check for cancel, deadline or latency budget exceeded
+            reply.text = chat.interrupt_reply(reply.text, sequence.context_start, rollback=reply.cancel.rollback)
+            self._retire(sequence)
+            return
+        if token == chat.model.token_eos() or token == chat.eos_token or reply.n_tokens >= chat.n_generate or chat.context_available() <= 0:
+            chat.tokens_cache += chat.tokenize_text(chat.eos)
+            self._commit(sequence)
+            return
+
+        chat.tokens_cache.append(token)
+        reply.n_tokens += 1
+        new_text = chat.detokenize_tokens([token])
+        reply.text += new_text
+
+        interrupt, reply.text = chat.check_eos_failure(reply.text)
+        if not interrupt:
+            interrupt, reply.text = chat.check_model_impersonation(reply.text, Chat.USER_KEY)
+        if not interrupt:
+            interrupt, reply.text = chat.check_model_impersonation(reply.text, Chat.SYSTEM_KEY)
+        if not interrupt and reply.grammar is None and chat.check_repetition(token, reply.n_tokens):
+            reply._emit(new_text)
+            interrupt = True
+        if interrupt:
+            self._commit(sequence)
+            return
+
+        reply._emit(new_text)
+        sequence.pending = [token]
+
+
+    def _commit(self, sequence: _Sequence) -> None:
+        sequence.reply.chat.add_message(Chat.ASSISTANT_KEY, sequence.reply.text)
+        self._retire(sequence)
+
+
+    def _retire(self, sequence: _Sequence, error: Exception | None = None) -> None:
+        """
+        Remove a sequence from the batch; its slot keeps the KV cache for the next reply of the chat
+
+        @param sequence: the sequence
+        @param error: the error that stopped the sequence
+        """
+        if error is not None:
+            del sequence.reply.chat.tokens_cache[sequence.context_start:]
+            self._ctx.kv_cache_seq_rm(sequence.slot.seq_id, 0, -1)
+            sequence.slot.tokens = []
+
+        self._active.remove(sequence)
+        sequence.slot.busy = False
+        sequence.sampler.close()
+        sequence.reply._finish(error)
+
+
+    def _evict(self, planned: list[tuple[_Sequence, list[int]]]) -> None:
+        """
+        Make room in the KV cache: first drop the cache kept by the idle slots,
+        then stop the newest sequence of the batch (its turn is rolled back)
+
+        @param planned: the sequences of the batch that did not fit
+        """
+        idle = [slot for slot in self._slots if not slot.busy and slot.tokens]
+        for slot in idle:
+            self._ctx.kv_cache_seq_rm(slot.seq_id, 0, -1)
+            slot.tokens = []
+        if not idle:
+            self._retire(planned[-1][0], error=MemoryError('The KV cache of the batch engine is full'))
@@ -0,0 +1,87 @@
+import time
+import threading
+
+
+class CancelToken:
+    """
+    Stop condition of a generation: an explicit cancel (from any thread or a signal handler),
+    a wall-clock deadline, a timeout from the start of the generation or a maximum latency
+    between two consecutive tokens. The conditions are checked once per generated token.
+    """
+
+    COMMIT = 'commit'
+    ROLLBACK = 'rollback'
+
+    def __init__(
+            self,
+            timeout: float | None = None,
+            deadline: float | None = None,
+            max_token_latency: float | None = None,
+            on_cancel: str = COMMIT
+    ) -> None:
+        """
+        Create a new CancelToken object
+
+        @param timeout: the maximum number of seconds of the generation
+        @param deadline: the `time.monotonic()` instant after which the generation stops
+        @param max_token_latency: the maximum number of seconds to wait for a single token (the first one includes the prompt evaluation)
+        @param on_cancel: what to do with the partial reply: `COMMIT` it to the context or `ROLLBACK` the whole turn
+        """
+        if on_cancel not in (self.COMMIT, self.ROLLBACK):
+            raise ValueError(f'Unknown cancel policy: {on_cancel!r}')
+
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_token_latency = max_token_latency
+        self.on_cancel = on_cancel
+        self.reason: str | None = None
+
+        self._event = threading.Event()
+        self._start_time = time.monotonic()
+        self._last_token_time = self._start_time
+
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+
+    @property
+    def rollback(self) -> bool:
+        return self.on_cancel == self.ROLLBACK
+
+
+    def cancel(self, reason: str = 'cancelled') -> None:
+        """
+        Ask the generation to stop at the next token
+
+        @param reason: the reason of the cancel
+        """
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+
+    def start(self) -> None:
+        """
+        Start the clocks of the timeout and of the token latency (called when the generation starts)
+        """
+        self._start_time = self._last_token_time = time.monotonic()
+
+
+    def check(self) -> bool:
+        """
+        Check if the generation must stop (called for every generated token)
+
+        @return: whether or not the generation must stop
+        """
+        now = time.monotonic()
+        if self.deadline is not None and now >= self.deadline:
+            self.cancel('deadline')
+        elif self.timeout is not None and now - self._start_time >= self.timeout:
+            self.cancel('timeout')
+        elif self.max_token_latency is not None and now - self._last_token_time >= self.max_token_latency:
+            self.cancel('latency')
+        self._last_token_time = now
+
+        return self.cancelled
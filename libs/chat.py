@@ -1,4 +1,15 @@
-from llama_cpp import Llama, LlamaGrammar
+import ctypes
+import threading
+from typing import Any, TYPE_CHECKING
+
+from .cancellation import CancelToken
+from .memory import kv_bytes_per_token, process_rss
+from .repetition import RepetitionDetector
+from .structured import StructuredOutputError, IncrementalJsonParser, grammar_for, schema_of, validate, instantiate
+
+# llama_cpp is imported only where it is used, so that importing this module is fast (see `Agent` background loading)
+if TYPE_CHECKING:
+    from llama_cpp import Llama, LlamaGrammar, LogitsProcessorList
 
 
 class Message:
@@ -10,6 +21,24 @@ class Message:
         return f'<{self.agent}> {self.content}'
 
 
+class ScoredCandidate:
+    def __init__(self, text: str, tokens: list[int], logprobs: list[float]) -> None:
+        self.text = text
+        self.tokens = tokens
+        self.logprobs = logprobs  # Log-probability of each token given the context and the previous tokens
+
+    @property
+    def total(self) -> float:
+        return sum(self.logprobs)
+
+    @property
+    def mean(self) -> float:
+        return self.total / len(self.logprobs) if self.logprobs else 0.0
+
+    def __repr__(self) -> str:
+        return f'<{self.total:.3f}> {self.text}'
+
+
 class Chat:
 
     SYSTEM_KEY = 'system'
@@ -21,7 +50,7 @@ class Chat:
 
     def __init__(
             self,
-            model: Llama,
+            model: 'Llama',
             n_generate: int,
             temperature: float = 0.8,
             top_p: float = 0.9,
@@ -38,7 +67,8 @@ class Chat:
             },
             bot: str = '',
             eos: str = '<|im_end|>\n',
-            debug=False
+            debug=False,
+            repetition: RepetitionDetector | None = None
     ) -> None:
         """
         Create a new Chat object
@@ -53,6 +83,7 @@ class Chat:
         @param bot: the token that starts the chat
         @param eos: the token that ends a single chat round
         @param debug: whether or not to output debug informations
+        @param repetition: the detector that stops (or penalizes) the replies that loop on the same text
         """
         self.model = model
         self.bot = bot
@@ -64,6 +95,7 @@ class Chat:
         self.agent_prefixes = agent_prefixes
         self.agent_names = agent_names
         self.debug = debug
+        self.repetition = repetition
 
         self.eos_token = self.tokenize_text(self.eos, add_bos=False, special=True)[0]
         self.bot_token = self.tokenize_text(self.bot, add_bos=False, special=True)[0] if len(self.bot) > 0 else None
@@ -73,100 +105,368 @@ class Chat:
         self.cache_initialize()
         
     
-    def generate_completion(self, text: str, grammar: LlamaGrammar | None = None):
+    def generate_completion(self, text: str, grammar: 'LlamaGrammar | None' = None, cancel: CancelToken | None = None):
         text_tokens = self.tokenize_text(text=text, add_bos=False, special=False)
         tokens_generated = 0
+        if cancel is not None: cancel.start()
         
         for token in self.model.generate(tokens=text_tokens, temp=self.temperature, top_p=self.top_p, top_k=self.top_k, grammar=grammar):
+            if cancel is not None and cancel.check(): break
             yield self.detokenize_tokens(tokens=[token], special=False)
             tokens_generated += 1
             if tokens_generated >= self.n_generate: break
 
 
-    def generate_assistant_reply(self, grammar: LlamaGrammar | None = None) -> tuple[str, int]:
+    def generate_assistant_reply(self, grammar: 'LlamaGrammar | None' = None, cancel: CancelToken | None = None) -> tuple[str, int]:
         """
         Get a response from the model (after a user message presumably) in a single final string.
 
         @param grammar: the grammar used to constrain the output of the model
+        @param cancel: the token that can stop the generation (the partial reply is committed or rolled back as it says)
         @return: the response text and the number of remaining tokens in the context
         """
+        context_start = len(self.tokens_cache)
         self.cache_append_header(agent=self.ASSISTANT_KEY)
+        if cancel is not None: cancel.start()
+        detect_loops = grammar is None  # Grammar-constrained replies (e.g. JSON arrays) can be legitimately repetitive
+        if detect_loops and self.repetition is not None: self.repetition.reset()
 
         reply = ''
         n_reply_tokens = 0
-        for token in self.model.generate(tokens=self.tokens_cache, temp=self.temperature, top_p=self.top_p, top_k=self.top_k, grammar=grammar):
-            self.check_context_overflow()  # Check for context exceeded
-            if token == self.model.token_eos() or token == self.eos_token:  # Check for EOS termination
-                self.tokens_cache += self.tokenize_text(self.eos)
-                break
-            if n_reply_tokens >= self.n_generate:  # Check if the model generated more tokens than it should in this chat turn
-                self.tokens_cache += self.tokenize_text(self.eos)
-                break
-
-            self.tokens_cache.append(token)
-            n_reply_tokens += 1
-            reply += self.detokenize_tokens([token])
-
-            interrupt, reply = self.check_eos_failure(reply)                            # Check for EOS detection failure due to multiple EOS tokens
-            if interrupt: break
-            interrupt, reply = self.check_model_impersonation(reply, self.USER_KEY)     # Check for model trying to impersonate the user before EOS
-            if interrupt: break
-            interrupt, reply = self.check_model_impersonation(reply, self.SYSTEM_KEY)   # Check for model trying to impersonate the system before EOS
-            if interrupt: break
+        try:
+            for token in self.model.generate(tokens=self.tokens_cache, temp=self.temperature, top_p=self.top_p, top_k=self.top_k, grammar=grammar, logits_processor=self._logits_processor() if detect_loops else None):
+                if cancel is not None and cancel.check():  # Check for cancel, deadline or latency budget exceeded
+                    reply = self.interrupt_reply(reply, context_start, rollback=cancel.rollback)
+                    return reply, self.context_available()
+                self.check_context_overflow()  # Check for context exceeded
+                if token == self.model.token_eos() or token == self.eos_token:  # Check for EOS termination
+                    self.tokens_cache += self.tokenize_text(self.eos)
+                    break
+                if n_reply_tokens >= self.n_generate:  # Check if the model generated more tokens than it should in this chat turn
+                    self.tokens_cache += self.tokenize_text(self.eos)
+                    break
+
+                self.tokens_cache.append(token)
+                n_reply_tokens += 1
+                reply += self.detokenize_tokens([token])
+
+                interrupt, reply = self.check_eos_failure(reply)                            # Check for EOS detection failure due to multiple EOS tokens
+                if interrupt: break
+                interrupt, reply = self.check_model_impersonation(reply, self.USER_KEY)     # Check for model trying to impersonate the user before EOS
+                if interrupt: break
+                interrupt, reply = self.check_model_impersonation(reply, self.SYSTEM_KEY)   # Check for model trying to impersonate the system before EOS
+                if interrupt: break
+                if detect_loops and self.check_repetition(token, n_reply_tokens): break  # Check for the model looping on the same text
+        except KeyboardInterrupt:
+            self.interrupt_reply(reply, context_start, rollback=cancel is not None and cancel.rollback)
+            raise
 
         self.add_message(self.ASSISTANT_KEY, reply)
 
         return reply, self.context_available()
 
 
-    def generate_assistant_reply_stepped(self, grammar: LlamaGrammar | None = None):
+    def generate_assistant_reply_stepped(self, grammar: 'LlamaGrammar | None' = None, cancel: CancelToken | None = None, terminal: bool = True):
         """
         Get a response from the model (after a user message presumably) as a stream of tokens.
+        If the stream is closed before the end, the partial reply is committed (or rolled back
+        as the cancel token says) so that the context stays consistent.
 
         @param grammar: the grammar used to constrain the output of the model
+        @param cancel: the token that can stop the generation (the partial reply is committed or rolled back as it says)
+        @param terminal: whether or not the stream ends with the text that closes the reply on a terminal (new line, erasing of the text cut from the reply)
         @return: the single (already detokenized) token generated
         """
+        context_start = len(self.tokens_cache)
         self.cache_append_header(agent=self.ASSISTANT_KEY)
+        if cancel is not None: cancel.start()
+        detect_loops = grammar is None
+        if detect_loops and self.repetition is not None: self.repetition.reset()
 
         reply = ''
         n_reply_tokens = 0
-        for token in self.model.generate(tokens=self.tokens_cache, temp=self.temperature, top_p=self.top_p, top_k=self.top_k, grammar=grammar):
-            self.check_context_overflow()
-            if token == self.model.token_eos() or token == self.eos_token:  # Check for EOS termination
-                self.tokens_cache += self.tokenize_text(self.eos)
-                yield '\n'
-                break
-            if n_reply_tokens >= self.n_generate:  # Check for max tokens reached
-                self.tokens_cache += self.tokenize_text(self.eos)
-                yield '\n'
-                break
+        tail = ''  # Text that closes the reply on the terminal, yielded once the context is consistent
+        last_text = ''  # Text of the reply not yielded yet when the generation stops
+        cancelled = False
+        try:
+            for token in self.model.generate(tokens=self.tokens_cache, temp=self.temperature, top_p=self.top_p, top_k=self.top_k, grammar=grammar, logits_processor=self._logits_processor() if detect_loops else None):
+                if cancel is not None and cancel.check():  # Check for cancel, deadline or latency budget exceeded
+                    reply = self.interrupt_reply(reply, context_start, rollback=cancel.rollback)
+                    cancelled = True
+                    tail = '\n'
+                    break
+                self.check_context_overflow()
+                if token == self.model.token_eos() or token == self.eos_token:  # Check for EOS termination
+                    self.tokens_cache += self.tokenize_text(self.eos)
+                    tail = '\n'
+                    break
+                if n_reply_tokens >= self.n_generate:  # Check for max tokens reached
+                    self.tokens_cache += self.tokenize_text(self.eos)
+                    tail = '\n'
+                    break
+
+                self.tokens_cache.append(token)
+                n_reply_tokens += 1
+                new_text = self.detokenize_tokens([token])
+                reply += new_text
+
+                interrupt, reply = self.check_eos_failure(reply)
+                if interrupt:  # Remove the broken EOS text from the terminal
+                    n_char_to_delete = len(self.eos) - 1
+                    back_str = '\b' * n_char_to_delete
+                    empty_str = ' ' * n_char_to_delete
+                    tail = back_str + empty_str + '\n'
+                    break
+                interrupt, reply = self.check_model_impersonation(reply, self.USER_KEY)
+                if interrupt:  # Remove the text generated by the impersionation from the terminal
+                    tail = self.CLEAR_CURRENT_LINE
+                    break
+                interrupt, reply = self.check_model_impersonation(reply, self.SYSTEM_KEY)
+                if interrupt:  # Remove the text generated by the impersionation from the terminal
+                    tail = self.CLEAR_CURRENT_LINE
+                    break
+                if detect_loops and self.check_repetition(token, n_reply_tokens):  # Stop the loop after showing the last token
+                    last_text = new_text
+                    tail = new_text + '\n'
+                    break
+
+                yield new_text
+        except (KeyboardInterrupt, GeneratorExit):  # Interrupted by the user or stream closed by the consumer
+            self.interrupt_reply(reply, context_start, rollback=cancel is not None and cancel.rollback)
+            raise
+
+        if not cancelled:
+            self.add_message(self.ASSISTANT_KEY, reply)
+        if not terminal: tail = last_text
+        if tail: yield tail
+
+
+    def generate_structured_reply(self, schema: dict | type, cancel: CancelToken | None = None) -> tuple[Any, int]:
+        """
+        Get a response from the model constrained to a JSON schema and parse it.
+
+        @param schema: a JSON schema or a dataclass
+        @param cancel: the token that can stop the generation (the partial reply is committed or rolled back as it says)
+        @return: the parsed object (a dataclass instance if a dataclass was given) and the number of remaining tokens in the context
+        """
+        value = None
+        for value in self.generate_structured_reply_stepped(schema, cancel=cancel):
+            pass
+
+        return value, self.context_available()
+
+
+    def generate_structured_reply_stepped(self, schema: dict | type, cancel: CancelToken | None = None):
+        """
+        Get a response from the model constrained to a JSON schema as a stream of partial objects.
+        The schema is converted to a grammar once. Partial objects are validated while they are
+        generated and the generation stops at the first validation failure.
+
+        @param schema: a JSON schema or a dataclass
+        @param cancel: the token that can stop the generation (the partial reply is committed or rolled back as it says)
+        @return: the partial objects parsed so far (plain JSON values), the last one is the final
+                 object (a dataclass instance if a dataclass was given)
+        """
+        json_schema = schema_of(schema)
+        parser = IncrementalJsonParser()
+
+        stream = self.generate_assistant_reply_stepped(grammar=grammar_for(schema), cancel=cancel)
+        for text in stream:
+            value = parser.feed(text)
+            if value is None:
+                continue
+
+            error = validate(value, json_schema, partial=True)
+            if error:  # Stop the generation early: the reply can't become valid anymore (closing commits the partial reply)
+                stream.close()
+                raise StructuredOutputError(f'Invalid structured output: {error}')
+
+            yield value
+
+        if cancel is not None and cancel.cancelled:
+            raise StructuredOutputError(f'Structured output interrupted ({cancel.reason}): {parser.text!r}')
+        if not parser.is_complete():
+            raise StructuredOutputError(f'Incomplete structured output: {parser.text!r}')
+        error = validate(parser.value, json_schema)
+        if error:
+            raise StructuredOutputError(f'Invalid structured output: {error}')
+
+        yield instantiate(parser.value, schema)
+
+
+    def interrupt_reply(self, reply: str, context_start: int, rollback: bool = False) -> str:
+        """
+        Close an assistant turn that was interrupted: either commit the partial reply with a proper EOS
+        or remove the whole turn from the context. In both cases the tokens already evaluated by the
+        model stay a prefix of the context, so the next turn doesn't re-evaluate the prompt.
 
-            self.tokens_cache.append(token)
-            n_reply_tokens += 1
-            new_text = self.detokenize_tokens([token])
-            reply += new_text
-
-            interrupt, reply = self.check_eos_failure(reply)
-            if interrupt:  # Remove the broken EOS text from the terminal
-                n_char_to_delete = len(self.eos) - 1
-                back_str = '\b' * n_char_to_delete
-                empty_str = ' ' * n_char_to_delete
-                yield back_str + empty_str + '\n'
-                break
-            interrupt, reply = self.check_model_impersonation(reply, self.USER_KEY)
-            if interrupt:  # Remove the text generated by the impersionation from the terminal
-                yield self.CLEAR_CURRENT_LINE
-                break
-            interrupt, reply = self.check_model_impersonation(reply, self.SYSTEM_KEY)
-            if interrupt:  # Remove the text generated by the impersionation from the terminal
-                yield self.CLEAR_CURRENT_LINE
-                break
+        @param reply: the text generated until the interruption
+        @param context_start: the length of the context before the header of the assistant turn
+        @param rollback: if the turn must be removed instead of committed
+        @return: the reply kept in the chat (empty if rolled back)
+        """
+        if rollback:
+            del self.tokens_cache[context_start:]
+            return ''
+
+        self.commit_partial_reply(reply)
+        return reply
 
-            yield new_text
 
+    def commit_partial_reply(self, reply: str) -> None:
+        """
+        Close an assistant turn that was stopped before the model produced the EOS,
+        so that the context stays consistent with the messages.
+
+        @param reply: the text generated until the interruption
+        """
+        self.tokens_cache += self.tokenize_text(self.eos)
         self.add_message(self.ASSISTANT_KEY, reply)
 
 
+    def prefill(self, tokens: list[int] | None = None, stop_event: threading.Event | None = None) -> int:
+        """
+        Evaluate ahead of time the tokens of the next prompt that are not in the model's KV cache yet.
+        The following generation finds them through the prefix matching of `Llama.generate`.
+
+        @param tokens: the tokens to evaluate (default: the current context)
+        @param stop_event: when set, the evaluation stops after the current batch
+        @return: the number of tokens evaluated
+        """
+        tokens = self.tokens_cache if tokens is None else tokens
+        n_past = self.model.longest_token_prefix(self.model._input_ids, tokens)
+        if n_past >= len(tokens):
+            return 0
+
+        self.model.n_tokens = n_past
+        n_evaluated = 0
+        for start in range(n_past, len(tokens), self.model.n_batch):
+            if stop_event is not None and stop_event.is_set():
+                break
+            batch = tokens[start:start + self.model.n_batch]
+            self.model.eval(batch)
+            n_evaluated += len(batch)
+
+        return n_evaluated
+
+
+    def score_candidates(self, candidates: list[str], context: list[int] | None = None, terminated: bool = False) -> list[ScoredCandidate]:
+        """
+        Compute the log-probability of some candidate continuations of a shared context, without sampling.
+        The context is evaluated once (only the part that is not in the KV cache already), then each
+        candidate is evaluated in a single forward pass that gives the logits of all its tokens.
+        The context of the chat is not changed.
+
+        @param candidates: the candidate texts
+        @param context: the tokens of the shared context (default: the current context followed by the header of an assistant turn)
+        @param terminated: whether or not each candidate must be followed by the EOS (so that a prefix of a longer text scores lower)
+        @return: the scores of the candidates, in the same order
+        """
+        import numpy as np
+
+        if context is None:
+            context = self.next_turn_tokens(self.ASSISTANT_KEY)
+
+        # The last token of the context is evaluated with each candidate, to get the logits of its first token
+        n_shared = len(context) - 1
+        self.prefill(context[:n_shared])
+        self.model.n_tokens = n_shared
+
+        n_vocab = self.model.n_vocab()
+        scores = []
+        try:
+            for text in candidates:
+                tokens = self.tokenize_text(text, special=False) + ([self.eos_token] if terminated else [])
+                inputs = context[n_shared:] + tokens[:-1]  # The logits of each input predict the next token
+                logprobs = []
+                self.model._ctx.kv_cache_seq_rm(-1, n_shared, -1)
+                for start in range(0, len(tokens), self.model.n_batch):
+                    batch = inputs[start:start + self.model.n_batch]
+                    self.model._batch.set_batch(batch=batch, n_past=n_shared + start, logits_all=True)
+                    self.model._ctx.decode(self.model._batch)
+
+                    logits = np.ctypeslib.as_array(self.model._ctx.get_logits(), shape=(len(batch), n_vocab))
+                    targets = tokens[start:start + len(batch)]
+                    max_logits = logits.max(axis=1)
+                    log_norm = max_logits + np.log(np.exp(logits - max_logits[:, None]).sum(axis=1))
+                    logprobs += (logits[np.arange(len(batch)), targets] - log_norm).tolist()
+
+                scores.append(ScoredCandidate(text, tokens, logprobs))
+        finally:
+            # Only the shared context is left in the KV cache, consistent with the model's evaluated tokens
+            self.model._ctx.kv_cache_seq_rm(-1, n_shared, -1)
+
+        return scores
+
+
+    def choose(self, choices: list[str], context: list[int] | None = None, normalize: bool = True) -> tuple[int, list[ScoredCandidate]]:
+        """
+        Choose the most likely continuation of a shared context among some choices (e.g. the labels of a classifier).
+        Each choice must be followed by the EOS, so that a choice that only starts the likely reply doesn't win.
+
+        @param choices: the texts to choose from
+        @param context: the tokens of the shared context (default: the current context followed by the header of an assistant turn)
+        @param normalize: whether or not to compare the mean log-probability per token instead of the total, so that longer choices are not penalized
+        @return: the index of the chosen text and the scores of all the choices
+        """
+        if not choices:
+            raise ValueError('There is nothing to choose from')
+
+        scores = self.score_candidates(choices, context=context, terminated=True)
+        index = max(range(len(scores)), key=lambda i: scores[i].mean if normalize else scores[i].total)
+
+        return index, scores
+
+
+    def save_kv_state(self) -> tuple[list[int], bytes]:
+        """
+        Get a snapshot of the model's state (KV cache included).
+        Evaluated tokens that are not part of the context (e.g. a speculative prefill)
+        are left out: they are discarded by the first evaluation after the restore.
+
+        @return: the context tokens evaluated by the model and the llama.cpp state
+        """
+        import llama_cpp
+        size = llama_cpp.llama_state_get_size(self.model.ctx)
+        buffer = (ctypes.c_uint8 * size)()
+        n_bytes = llama_cpp.llama_state_get_data(self.model.ctx, buffer, size)
+        n_past = self.model.longest_token_prefix(self.model._input_ids, self.tokens_cache)
+
+        return self.model._input_ids[:n_past].tolist(), ctypes.string_at(buffer, n_bytes)
+
+
+    def load_kv_state(self, tokens: list[int], data: bytes) -> None:
+        """
+        Restore a snapshot of the model's state, so that the tokens don't need to be evaluated again
+
+        @param tokens: the tokens evaluated in the snapshot
+        @param data: the llama.cpp state
+        """
+        import llama_cpp
+        buffer = (ctypes.c_uint8 * len(data)).from_buffer_copy(data)
+        if llama_cpp.llama_state_set_data(self.model.ctx, buffer, len(data)) != len(data):
+            raise RuntimeError('Failed to restore the llama state')
+
+        self.model.input_ids[:len(tokens)] = tokens
+        self.model.n_tokens = len(tokens)
+
+
+    def next_turn_tokens(self, agent: str, pending: list[Message] | None = None) -> list[int]:
+        """
+        Get the tokens that will surely start the context of the next turn of an agent
+
+        @param agent: the agent of the next turn
+        @param pending: the messages that will be sent before the next turn
+        @return: the context, followed by the pending messages and the header of the agent
+        """
+        tokens = list(self.tokens_cache)
+        for message in pending or []:
+            tokens += self.tokenize_text(f'{self.agent_prefixes[message.agent]}{message.content}{self.eos}')
+        tokens += self.tokenize_text(self.agent_prefixes[agent])
+
+        return tokens
+
+
     def send_message(self, agent: str, content: str) -> int:
         """
         Append a message to the context of the chat
@@ -232,6 +532,36 @@ class Chat:
         return interrupt, reply
 
 
+    def check_repetition(self, token: int, n_reply_tokens: int) -> bool:
+        """
+        Check if the model is looping on the same text and, if so, close the reply with the EOS
+
+        @param token: the last token of the reply
+        @param n_reply_tokens: the number of tokens of the reply
+        @return: whether or not the reply must stop
+        """
+        if self.repetition is None or not self.repetition.feed(token):
+            return False
+
+        if self.debug: print(f'[DEBUG] Repetition detected ({self.repetition.reason}) after {n_reply_tokens} tokens')
+        self.repetition.unused_budget += self.n_generate - n_reply_tokens
+        self.tokens_cache += self.tokenize_text(self.eos)
+        return True
+
+
+    def _logits_processor(self) -> 'LogitsProcessorList | None':
+        """
+        Get the logits processors of the generation
+
+        @return: the processors, None if there are none
+        """
+        if self.repetition is None or self.repetition.action != RepetitionDetector.PENALTY:
+            return None
+
+        from llama_cpp import LogitsProcessorList
+        return LogitsProcessorList([self.repetition.logits_processor])
+
+
     def cache_initialize(self) -> None:
         """
         Initialize the context and re-add the BOS if needed
@@ -356,6 +686,26 @@ class Chat:
         return len(self.tokens_cache)
 
 
+    def memory_report(self) -> dict[str, int]:
+        """
+        Get the memory used by the chat
+
+        @return: the bytes of KV cache per token, used by the evaluated tokens and allocated for the whole context,
+            the size of a state snapshot (see `save_kv_state`) and the resident memory of the process
+        """
+        import llama_cpp
+        params = self.model.context_params
+        bytes_per_token = kv_bytes_per_token(self.model.metadata, params.type_k, params.type_v)
+
+        return {
+            'kv_bytes_per_token': bytes_per_token,
+            'kv_used_bytes': self.model.n_tokens * bytes_per_token,
+            'kv_allocated_bytes': self.model.n_ctx() * bytes_per_token,
+            'snapshot_bytes': llama_cpp.llama_state_get_size(self.model.ctx),
+            'rss_bytes': process_rss()
+        }
+
+
     def get_raw_chat(self) -> str:
         """
         Get the raw chat text
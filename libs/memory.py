@@ -0,0 +1,183 @@
+import os
+import struct
+from typing import Callable
+
+# Supported KV cache types (name -> GGML type)
+KV_CACHE_TYPES = {
+    'f32': 0,
+    'f16': 1,
+    'q8_0': 8,
+    'q4_0': 2
+}
+
+# Bytes per element of the GGML types usable for the KV cache (quantized types store blocks of 32 values)
+GGML_TYPE_SIZES = {
+    0: 4.0,         # F32
+    1: 2.0,         # F16
+    2: 18 / 32,     # Q4_0
+    3: 20 / 32,     # Q4_1
+    6: 22 / 32,     # Q5_0
+    7: 24 / 32,     # Q5_1
+    8: 34 / 32,     # Q8_0
+    20: 18 / 32,    # IQ4_NL
+    30: 2.0         # BF16
+}
+
+# GGUF metadata value types: struct format of the fixed-size ones
+_GGUF_SCALARS = {0: '<B', 1: '<b', 2: '<H', 3: '<h', 4: '<I', 5: '<i', 6: '<f', 7: '<?', 10: '<Q', 11: '<q', 12: '<d'}
+_GGUF_STRING = 8
+_GGUF_ARRAY = 9
+
+
+def read_gguf_metadata(path: str, keys: set[str] | None = None) -> dict:
+    """
+    Read the metadata of a GGUF file without loading the model.
+    Arrays (e.g. the tokenizer vocabulary) are skipped.
+
+    @param path: the path of the GGUF file
+    @param keys: the keys to read, the reading stops once all of them are found (default: all the scalar keys)
+    @return: the metadata values by key
+    """
+    metadata = {}
+    with open(path, 'rb') as f:
+        magic, version = struct.unpack('<4sI', f.read(8))
+        if magic != b'GGUF' or version < 2:
+            raise ValueError(f'{path} is not a supported GGUF file')
+        _, n_kv = struct.unpack('<QQ', f.read(16))
+
+        for _ in range(n_kv):
+            key = _read_gguf_string(f)
+            value_type, = struct.unpack('<I', f.read(4))
+            if value_type == _GGUF_ARRAY:
+                _skip_gguf_array(f)
+                continue
+
+            value = _read_gguf_value(f, value_type)
+            if keys is None or key in keys:
+                metadata[key] = value
+                if keys is not None and len(metadata) == len(keys):
+                    break
+
+    return metadata
+
+
+def kv_bytes_per_token(metadata: dict, type_k: int = 1, type_v: int = 1) -> int:
+    """
+    Compute the size of the KV cache of a single token
+
+    @param metadata: the model metadata (values can be strings, as returned by `Llama.metadata`)
+    @param type_k: the GGML type of the keys cache
+    @param type_v: the GGML type of the values cache
+    @return: the number of bytes used by each token in the KV cache
+    """
+    arch = metadata['general.architecture']
+    n_layer = int(metadata[f'{arch}.block_count'])
+    n_embd = int(metadata[f'{arch}.embedding_length'])
+    n_head = int(metadata[f'{arch}.attention.head_count'])
+    n_head_kv = int(metadata.get(f'{arch}.attention.head_count_kv', n_head))
+    head_k = int(metadata.get(f'{arch}.attention.key_length', n_embd // n_head))
+    head_v = int(metadata.get(f'{arch}.attention.value_length', n_embd // n_head))
+
+    return int(n_layer * n_head_kv * (head_k * GGML_TYPE_SIZES[type_k] + head_v * GGML_TYPE_SIZES[type_v]))
+
+
+def n_ctx_for_budget(model_path: str, budget_bytes: int, type_k: int = 1, type_v: int = 1, multiple: int = 256) -> int:
+    """
+    Compute the largest context that fits a memory budget for the KV cache
+
+    @param model_path: the path of the GGUF file
+    @param budget_bytes: the memory budget for the KV cache
+    @param type_k: the GGML type of the keys cache
+    @param type_v: the GGML type of the values cache
+    @param multiple: the context size is rounded down to a multiple of this value
+    @return: the context size, capped to the training context of the model
+    """
+    metadata = read_gguf_metadata(model_path)
+    arch = metadata['general.architecture']
+    n_ctx = budget_bytes // kv_bytes_per_token(metadata, type_k, type_v) // multiple * multiple
+    if n_ctx < multiple:
+        raise ValueError(f'A budget of {budget_bytes} bytes is too small for the KV cache of {model_path}')
+
+    return min(n_ctx, int(metadata.get(f'{arch}.context_length', n_ctx)))
+
+
+def prewarm_file(path: str, chunk_size: int = 16 * 1024 * 1024, progress: Callable[[float], None] | None = None) -> int:
+    """
+    Read a whole file once so that its pages are in the page cache: a model memory-mapped
+    afterwards doesn't stall on disk reads (page faults) during the first evaluations
+
+    @param path: the path of the file
+    @param chunk_size: the size of each read
+    @param progress: function called with the fraction of the file read after each chunk
+    @return: the number of bytes read
+    """
+    size = os.path.getsize(path)
+    n_read = 0
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        buffer = bytearray(chunk_size)
+        while n := f.readinto(buffer):
+            n_read += n
+            if progress is not None:
+                progress(n_read / size)
+
+    return n_read
+
+
+def drop_file_cache(path: str) -> bool:
+    """
+    Ask the kernel to drop the pages of a file from the page cache, so that the next reads come from disk
+    (pages that are mapped or locked by some process stay in memory)
+
+    @param path: the path of the file
+    @return: whether or not the platform supports the request
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+
+    with open(path, 'rb') as f:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return True
+
+
+def process_rss() -> int:
+    """
+    Get the resident memory of the current process
+
+    @return: the resident set size in bytes (the peak one where the current one is not available)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _read_gguf_string(f) -> str:
+    length, = struct.unpack('<Q', f.read(8))
+    return f.read(length).decode('UTF-8', errors='replace')
+
+
+def _read_gguf_value(f, value_type: int):
+    if value_type == _GGUF_STRING:
+        return _read_gguf_string(f)
+    fmt = _GGUF_SCALARS[value_type]
+    return struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
+
+
+def _skip_gguf_array(f) -> None:
+    item_type, n_items = struct.unpack('<IQ', f.read(12))
+    if item_type in _GGUF_SCALARS:
+        f.seek(n_items * struct.calcsize(_GGUF_SCALARS[item_type]), os.SEEK_CUR)
+    elif item_type == _GGUF_STRING:
+        for _ in range(n_items):
+            length, = struct.unpack('<Q', f.read(8))
+            f.seek(length, os.SEEK_CUR)
+    else:
+        for _ in range(n_items):
+            _skip_gguf_array(f)
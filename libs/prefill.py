@@ -0,0 +1,59 @@
+import threading
+
+from .chat import Chat
+
+
+class SpeculativePrefill:
+    """
+    Evaluate in background the part of the next prompt that is already known (the context
+    and the header of the next turn) while the program waits for something else, usually the
+    user input. Once stopped, the next generation only needs to evaluate the new tokens.
+    """
+
+    def __init__(self, chat: Chat) -> None:
+        """
+        Create a new SpeculativePrefill object
+
+        @param chat: the chat whose model will be prefilled
+        """
+        self.chat = chat
+        self.n_evaluated = 0
+
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+
+
+    def start(self, tokens: list[int]) -> None:
+        """
+        Start evaluating the tokens in background
+
+        @param tokens: the tokens that will surely prefix the next prompt
+        """
+        self.stop()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, args=(list(tokens),), name='prefill', daemon=True)
+        self._thread.start()
+
+
+    def stop(self) -> int:
+        """
+        Stop the prefill after the batch being evaluated and wait for it.
+        The model must not be used by anyone else before this method returns.
+
+        @return: the number of tokens evaluated in background
+        """
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+        return self.n_evaluated
+
+
+    def _run(self, tokens: list[int]) -> None:
+        """
+        Body of the background thread
+
+        @param tokens: the tokens to evaluate
+        """
+        self.n_evaluated = self.chat.prefill(tokens, stop_event=self._stop_event)
@@ -0,0 +1,183 @@
+from collections import deque
+
+
+class RepetitionDetector:
+    """
+    Online detector of degenerate replies (the model looping on the same text), fed with the
+    token IDs of a reply as they are generated. Memory and time per token are bounded:
+    - periods: for every period up to `max_period`, the length of the current run of tokens
+      equal to the token `period` positions before (a ring buffer of the last tokens)
+    - n-grams: rolling hashes of the last `ngram_size` tokens, counted over the last `window`
+      positions, to catch loops that are not exactly periodic
+
+    With `STOP` the reply ends when a loop is detected. With `PENALTY` the tokens that would
+    continue a periodic loop get their logits lowered, and the reply ends only if a loop lasts
+    twice as long anyway.
+    """
+
+    STOP = 'stop'
+    PENALTY = 'penalty'
+
+    HASH_BASE = 1_000_003
+    HASH_MODULUS = (1 << 61) - 1
+
+    def __init__(
+            self,
+            action: str = STOP,
+            max_period: int = 64,
+            min_repeats: int = 3,
+            min_length: int = 32,
+            ngram_size: int = 12,
+            max_ngram_repeats: int = 5,
+            window: int = 512,
+            penalty: float = 5.0
+    ) -> None:
+        """
+        Create a new RepetitionDetector object
+
+        @param action: what to do when a loop is detected: `STOP` the reply or apply a `PENALTY`
+        @param max_period: the longest loop (in tokens) that is detected as a period
+        @param min_repeats: the number of consecutive copies of a period that make a loop
+        @param min_length: the minimum number of repeated tokens that make a loop (so that short runs like '-----' are allowed)
+        @param ngram_size: the length of the n-grams whose repetitions are counted
+        @param max_ngram_repeats: the number of occurrences of the same n-gram within the window that make a loop
+        @param window: the number of recent positions where the n-grams are counted
+        @param penalty: the value subtracted from the logits of the tokens that continue a loop
+        """
+        if action not in (self.STOP, self.PENALTY):
+            raise ValueError(f'Unknown repetition action: {action!r}')
+
+        self.action = action
+        self.max_period = max_period
+        self.min_repeats = min_repeats
+        self.min_length = min_length
+        self.ngram_size = ngram_size
+        self.max_ngram_repeats = max_ngram_repeats
+        self.window = window
+        self.penalty = penalty
+
+        self._hash_power = pow(self.HASH_BASE, ngram_size - 1, self.HASH_MODULUS)  # Weight of the token leaving the n-gram
+
+        # Totals over all the replies
+        self.n_detections = 0
+        self.unused_budget = 0  # Tokens of the reply budget left when the replies were stopped (at most the tokens saved)
+
+        self.reset()
+
+
+    def reset(self) -> None:
+        """
+        Forget the tokens seen (called when a new reply starts)
+        """
+        self.reason: str | None = None
+        self._n_tokens = 0
+        self._recent = [0] * self.max_period
+        self._runs = [0] * (self.max_period + 1)    # Run length of each period (index 0 unused)
+        self._predicted: set[int] = set()           # Tokens that would continue a loop
+
+        self._ngram = deque()
+        self._hash = 0
+        self._hashes = deque()                      # Hashes counted in the window (None where not counted)
+        self._hash_counts: dict[int, int] = {}
+        self._hash_positions: dict[int, int] = {}   # Position of the last counted occurrence of each hash
+
+
+    def feed(self, token: int) -> bool:
+        """
+        Add the next token of the reply
+
+        @param token: the token ID
+        @return: whether or not the reply must stop
+        """
+        n = self._n_tokens
+        longest_loop = 0
+        for period in range(1, min(self.max_period, n) + 1):
+            if self._recent[(n - period) % self.max_period] == token:
+                self._runs[period] += 1
+                longest_loop = max(longest_loop, self._runs[period] / self._threshold(period))
+            else:
+                self._runs[period] = 0
+        self._recent[n % self.max_period] = token
+        self._n_tokens = n = n + 1
+
+        # The token expected next by every loop long enough to be penalized
+        self._predicted = {
+            self._recent[(n - period) % self.max_period]
+            for period in range(1, min(self.max_period, n) + 1)
+            if self._runs[period] >= self._threshold(period)
+        }
+
+        tolerance = 2 if self.action == self.PENALTY else 1
+        if longest_loop >= tolerance:
+            return self._detected('period')
+        if self._ngram_repeats(token) >= self.max_ngram_repeats * tolerance:
+            return self._detected('ngram')
+
+        return False
+
+
+    def logits_processor(self, input_ids, scores):
+        """
+        Lower the logits of the tokens that would continue a loop
+        (a llama-cpp-python logits processor, used only with `PENALTY`)
+
+        @param input_ids: the tokens evaluated so far
+        @param scores: the logits of the next token
+        @return: the updated logits
+        """
+        for token in self._predicted:
+            scores[token] -= self.penalty
+
+        return scores
+
+
+    def _threshold(self, period: int) -> int:
+        """
+        Get the length of the run that makes a loop for a period
+
+        @param period: the period
+        @return: the number of tokens equal to the token `period` positions before
+        """
+        return max(period * (self.min_repeats - 1), self.min_length)
+
+
+    def _ngram_repeats(self, token: int) -> int:
+        """
+        Update the rolling hash of the last n-gram and count its occurrences in the window
+
+        @param token: the new token
+        @return: the number of non-overlapping occurrences of the last n-gram (0 until `ngram_size` tokens are seen)
+        """
+        if len(self._ngram) == self.ngram_size:
+            oldest = self._ngram.popleft()
+            self._hash = (self._hash - (oldest + 1) * self._hash_power) % self.HASH_MODULUS
+        self._ngram.append(token)
+        self._hash = (self._hash * self.HASH_BASE + token + 1) % self.HASH_MODULUS
+        if len(self._ngram) < self.ngram_size:
+            return 0
+
+        # Overlapping occurrences are not counted, so that short periods are left to the period check
+        position = self._n_tokens
+        last_position = self._hash_positions.get(self._hash)
+        if last_position is None or position - last_position >= self.ngram_size:
+            self._hashes.append(self._hash)
+            self._hash_counts[self._hash] = self._hash_counts.get(self._hash, 0) + 1
+            self._hash_positions[self._hash] = position
+        else:
+            self._hashes.append(None)
+
+        if len(self._hashes) > self.window:
+            expired = self._hashes.popleft()
+            if expired is not None:
+                self._hash_counts[expired] -= 1
+                if self._hash_counts[expired] == 0:
+                    del self._hash_counts[expired]
+                    del self._hash_positions[expired]
+
+        return self._hash_counts.get(self._hash, 0)
+
+
+    def _detected(self, reason: str) -> bool:
+        self.reason = reason
+        self.n_detections += 1
+        return True
@@ -0,0 +1,518 @@
+import os
+import queue
+import itertools
+import threading
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing.connection import Connection, wait
+from typing import Iterator
+
+from .autotune import AutoTuner
+
+
+class WorkerError(RuntimeError):
+    pass
+
+
+class _Worker:
+    def __init__(self, index: int, process: multiprocessing.Process, conn: Connection, cpus: set[int] | None, n_threads: int) -> None:
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.cpus = cpus
+        self.n_threads = n_threads
+        self.pid: int | None = None
+        self.alive = True
+        self.load = 0                   # Requests sent and not finished yet
+        self.sessions: set[str] = set()
+
+        self.send_lock = threading.Lock()
+        self.ready = threading.Event()
+        self.error: str | None = None
+
+
+class ChatRouter:
+    """
+    Front of a pool of worker processes, each one owning its own `Agent` (and model) with a
+    fixed number of threads and optionally pinned to a set of CPUs, so that the throughput
+    grows with the cores of the host instead of being bound to a single llama.cpp context
+    and to the GIL.
+
+    Sessions are sticky: all the requests of a session go to the same worker. A worker has a
+    single llama.cpp context, so when it switches to another session it keeps a snapshot of the
+    KV cache of the previous one (up to `session_cache_mb` per worker, least recently used
+    first out) and restores it when that session comes back, instead of evaluating its context
+    again. When a worker is overloaded and an idle session asks for a new reply, the session
+    moves to the least loaded worker together with its history (its context is evaluated again
+    there). Replies are streamed back over pipes.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            n_workers: int = 2,
+            n_threads: int | None = None,
+            pin_cpus: bool = False,
+            cpu_sets: list[set[int]] | None = None,
+            max_load: int = 2,
+            session_cache_mb: int = 1024,
+            **agent_params
+    ) -> None:
+        """
+        Create a new ChatRouter object and start its workers
+
+        @param name: the name of the model loaded by every worker (see `Agent`)
+        @param n_workers: the number of worker processes
+        @param n_threads: the llama.cpp threads of each worker (default: the worker CPUs, or the host CPUs split among the workers)
+        @param pin_cpus: whether or not to pin each worker to its own share of the CPUs this process can run on
+        @param cpu_sets: the CPUs of each worker (e.g. one NUMA node each), overrides `pin_cpus`
+        @param max_load: the number of pending requests from which a worker is overloaded and idle sessions move away from it
+        @param session_cache_mb: the memory of each worker for the KV cache snapshots of the sessions that are not being served
+        @param agent_params: the other parameters of the workers' `Agent`
+        """
+        if cpu_sets is not None:
+            n_workers = len(cpu_sets)
+        elif pin_cpus:
+            cpu_sets = self.split_cpus(n_workers)
+        if n_workers < 1:
+            raise ValueError('At least one worker is needed')
+
+        self.name = name
+        self.max_load = max_load
+        self.agent_params = agent_params
+
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._streams: dict[int, queue.Queue] = {}         # Request ID -> events of the request
+        self._requests: dict[int, tuple[str, str, _Worker]] = {}  # Request ID -> (session ID, user message, worker)
+        self._affinity: dict[str, _Worker] = {}            # Session ID -> worker
+        self._history: dict[str, list[tuple[str, str]]] = {}  # Session ID -> (agent, content) of the messages
+        self._session_load: dict[str, int] = {}            # Session ID -> pending requests
+
+        # Workers are spawned (not forked) so that they don't inherit the threads of this process
+        context = multiprocessing.get_context('spawn')
+        self._workers: list[_Worker] = []
+        for index in range(n_workers):
+            cpus = set(cpu_sets[index]) if cpu_sets is not None else None
+            threads = n_threads or (len(cpus) if cpus else max(1, AutoTuner.available_cpus() // n_workers))
+            conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_worker_main,
+                args=(child_conn, name, threads, cpus, session_cache_mb * 1024 * 1024, agent_params),
+                name=f'chat-worker-{index}',
+                daemon=True
+            )
+            process.start()
+            child_conn.close()
+            self._workers.append(_Worker(index, process, conn, cpus, threads))
+
+        self._closed = False
+        self._dispatcher = threading.Thread(target=self._dispatch, name='chat-router', daemon=True)
+        self._dispatcher.start()
+
+
+    @staticmethod
+    def split_cpus(n_workers: int) -> list[set[int]]:
+        """
+        Split the CPUs this process can run on into contiguous groups, one for each worker
+
+        @param n_workers: the number of workers
+        @return: the CPUs of each worker
+        """
+        if not hasattr(os, 'sched_getaffinity'):
+            raise WorkerError('CPU pinning is not supported on this platform')
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) < n_workers:
+            raise WorkerError(f'{n_workers} workers cannot be pinned to {len(cpus)} CPUs')
+
+        size, extra = divmod(len(cpus), n_workers)
+        groups, start = [], 0
+        for index in range(n_workers):
+            end = start + size + (index < extra)
+            groups.append(set(cpus[start:end]))
+            start = end
+
+        return groups
+
+
+    def wait_ready(self, timeout: float | None = None) -> None:
+        """
+        Wait for all the workers to load their model
+
+        @param timeout: the maximum number of seconds to wait for each worker
+        """
+        for worker in self._workers:
+            if not worker.ready.wait(timeout):
+                raise WorkerError(f'Worker {worker.index} is not ready after {timeout} seconds')
+            if worker.error is not None:
+                raise WorkerError(f'Worker {worker.index} failed to start: {worker.error}')
+
+
+    def stream(self, session_id: str, text: str) -> Iterator[str]:
+        """
+        Send a user message to a session and stream the reply.
+        Closing the stream early stops the generation (the partial reply stays in the session).
+
+        @param session_id: the session ID (a new session is created on its first message)
+        @param text: the user message
+        @return: the chunks of text of the reply
+        """
+        request_id, events = self._submit(session_id, text)
+        finished = False
+        try:
+            while True:
+                kind, payload = events.get()
+                if kind == 'chunk':
+                    yield payload
+                elif kind == 'done':
+                    finished = True
+                    return
+                else:
+                    finished = True
+                    raise WorkerError(payload)
+        finally:
+            if not finished:
+                self._cancel(request_id)
+
+
+    def ask(self, session_id: str, text: str) -> str:
+        """
+        Send a user message to a session and wait for the whole reply
+
+        @param session_id: the session ID (a new session is created on its first message)
+        @param text: the user message
+        @return: the reply as stored in the session
+        """
+        _, events = self._submit(session_id, text)
+        while True:
+            kind, payload = events.get()
+            if kind == 'done':
+                return payload
+            if kind == 'error':
+                raise WorkerError(payload)
+
+
+    def close_session(self, session_id: str) -> None:
+        """
+        Forget a session and free its context in the worker
+
+        @param session_id: the session ID
+        """
+        with self._lock:
+            worker = self._affinity.pop(session_id, None)
+            self._history.pop(session_id, None)
+            self._session_load.pop(session_id, None)
+            if worker is not None:
+                worker.sessions.discard(session_id)
+                self._send(worker, ('close', session_id))
+
+
+    def stats(self) -> list[dict]:
+        """
+        Get the state of the workers
+
+        @return: for each worker its process ID, CPUs, threads, pending requests and number of sessions
+        """
+        with self._lock:
+            return [{
+                'pid': worker.pid,
+                'alive': worker.alive,
+                'cpus': sorted(worker.cpus) if worker.cpus else None,
+                'n_threads': worker.n_threads,
+                'load': worker.load,
+                'sessions': len(worker.sessions)
+            } for worker in self._workers]
+
+
+    def shutdown(self) -> None:
+        """
+        Stop the workers (the pending requests fail)
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for worker in self._workers:
+            if worker.alive:
+                self._send(worker, ('stop',))
+        for worker in self._workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.conn.close()
+        self._dispatcher.join(timeout=1)
+
+
+    def __enter__(self) -> 'ChatRouter':
+        return self
+
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+
+
+    def _submit(self, session_id: str, text: str) -> tuple[int, queue.Queue]:
+        """
+        Route a user message to a worker
+
+        @param session_id: the session ID
+        @param text: the user message
+        @return: the request ID and the queue of its events
+        """
+        if self._closed:
+            raise WorkerError('The router was shut down')
+
+        with self._lock:
+            worker, history = self._route(session_id)
+            request_id = next(self._request_ids)
+            events = queue.Queue()
+            self._streams[request_id] = events
+            self._requests[request_id] = (session_id, text, worker)
+            self._session_load[session_id] = self._session_load.get(session_id, 0) + 1
+            worker.load += 1
+            self._send(worker, ('chat', request_id, session_id, text, history))
+
+        return request_id, events
+
+
+    def _route(self, session_id: str) -> tuple[_Worker, list[tuple[str, str]] | None]:
+        """
+        Choose the worker of a request (called with the lock held)
+
+        @param session_id: the session ID
+        @return: the worker and, if the session moves to it, the history to rebuild there
+        """
+        alive = [worker for worker in self._workers if worker.alive]
+        if not alive:
+            raise WorkerError('No worker is alive')
+        current = self._affinity.get(session_id)
+
+        # Requests of the same session must stay in order on the same worker
+        if current is not None and current.alive and (current.load < self.max_load or self._session_load.get(session_id, 0) > 0):
+            return current, None
+
+        best = min(alive, key=lambda worker: (worker.load, len(worker.sessions)))
+        if current is not None and current.alive and best.load >= current.load:
+            return current, None
+
+        history = None
+        if current is not None:
+            current.sessions.discard(session_id)
+            if current.alive:
+                self._send(current, ('close', session_id))
+            history = self._history.get(session_id, [])
+        self._affinity[session_id] = best
+        best.sessions.add(session_id)
+
+        return best, history
+
+
+    def _send(self, worker: _Worker, message: tuple) -> None:
+        with worker.send_lock:
+            try:
+                worker.conn.send(message)
+            except (OSError, ValueError):  # Dead worker, its requests fail in the dispatcher
+                pass
+
+
+    def _cancel(self, request_id: int) -> None:
+        with self._lock:
+            # The worker of the request, even if the session was closed or moved in the meantime
+            request = self._requests.get(request_id)
+            if request is not None:
+                self._send(request[2], ('cancel', request_id))
+
+
+    def _dispatch(self) -> None:
+        """
+        Body of the thread that receives the events of all the workers
+        """
+        connections = {worker.conn: worker for worker in self._workers}
+        while connections:
+            for conn in wait(list(connections)):
+                worker = connections[conn]
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    del connections[conn]
+                    self._worker_died(worker)
+                    continue
+                self._handle(worker, message)
+
+
+    def _handle(self, worker: _Worker, message: tuple) -> None:
+        """
+        Handle an event of a worker
+
+        @param worker: the worker that sent the event
+        @param message: the event
+        """
+        kind = message[0]
+        if kind == 'ready':
+            worker.pid = message[1]
+            worker.ready.set()
+        elif kind == 'failed':
+            worker.error = message[1]
+            worker.ready.set()
+        elif kind == 'chunk':
+            _, request_id, text = message
+            events = self._streams.get(request_id)
+            if events is not None:
+                events.put(('chunk', text))
+        elif kind in ('done', 'error'):
+            _, request_id, payload = message
+            with self._lock:
+                events = self._streams.pop(request_id, None)
+                session_id, text, _ = self._requests.pop(request_id)
+                worker.load -= 1
+                if session_id in self._session_load:
+                    self._session_load[session_id] -= 1
+                if kind == 'done':
+                    reply, reset = payload
+                    if session_id in self._affinity:  # Closed sessions have no history to update
+                        history = self._history.setdefault(session_id, [])
+                        if reset:
+                            history.clear()
+                        history += [('user', text), ('assistant', reply)]
+                    payload = reply
+            if events is not None:
+                events.put((kind, payload))
+
+
+    def _worker_died(self, worker: _Worker) -> None:
+        """
+        Fail the pending requests of a dead worker; its sessions move to the other workers
+
+        @param worker: the dead worker
+        """
+        worker.process.join(timeout=1)
+        with self._lock:
+            worker.alive = False
+            worker.load = 0
+            worker.ready.set()
+            if worker.error is None and not self._closed:
+                worker.error = f'exit code {worker.process.exitcode}'
+            failed = [request_id for request_id, (_, _, request_worker) in self._requests.items() if request_worker is worker]
+            for request_id in failed:
+                session_id, _, _ = self._requests.pop(request_id)
+                if session_id in self._session_load:
+                    self._session_load[session_id] -= 1
+                self._streams.pop(request_id).put(('error', f'Worker {worker.index} died ({worker.error})'))
+
+
+def _worker_main(conn: Connection, name: str, n_threads: int, cpus: set[int] | None, session_cache_bytes: int, agent_params: dict) -> None:
+    """
+    Body of a worker process: load the model and serve the requests of the router in order
+
+    @param conn: the pipe to the router
+    @param name: the name of the model
+    @param n_threads: the llama.cpp threads
+    @param cpus: the CPUs the worker is pinned to
+    @param session_cache_bytes: the memory for the KV cache snapshots of the sessions that are not being served
+    @param agent_params: the other parameters of the `Agent`
+    """
+    try:
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+
+        # Imported here: the router process does not need llama.cpp
+        from .agent import Agent
+        from .chat import Chat, Message
+        from .cancellation import CancelToken
+
+        agent = Agent(name, n_threads=n_threads, **agent_params)
+    except Exception as e:
+        conn.send(('failed', repr(e)))
+        return
+    conn.send(('ready', os.getpid()))
+
+    # A reader thread receives the requests, so that a cancel can reach the reply being generated
+    requests = queue.Queue()
+    cancel_tokens: dict[int, CancelToken] = {}
+
+    def read_requests():
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                message = ('stop',)
+            if message[0] == 'cancel':
+                token = cancel_tokens.get(message[1])
+                if token is not None:
+                    token.cancel('cancelled')
+                continue
+            if message[0] == 'chat':
+                cancel_tokens[message[1]] = CancelToken(timeout=agent.reply_timeout, max_token_latency=agent.max_token_latency)
+            requests.put(message)
+            if message[0] == 'stop':
+                return
+
+    threading.Thread(target=read_requests, name='chat-worker-reader', daemon=True).start()
+
+    chats: dict[str, Chat] = {}
+    snapshots: OrderedDict[str, tuple[list[int], bytes]] = OrderedDict()  # Least recently used first
+    snapshots_size = 0
+    active = None  # The session whose context is evaluated in the model
+
+    def pop_snapshot(session_id: str) -> tuple[list[int], bytes] | None:
+        nonlocal snapshots_size
+        snapshot = snapshots.pop(session_id, None)
+        if snapshot is not None:
+            snapshots_size -= len(snapshot[1])
+        return snapshot
+
+    def switch_to(session_id: str) -> None:
+        # Keep the KV cache of the previous session and restore the one of the new session, if any
+        nonlocal active, snapshots_size
+        if session_id == active:
+            return
+        if active in chats:
+            tokens, data = chats[active].save_kv_state()
+            if len(data) <= session_cache_bytes:
+                snapshots[active] = (tokens, data)
+                snapshots_size += len(data)
+                while snapshots_size > session_cache_bytes:
+                    pop_snapshot(next(iter(snapshots)))
+        snapshot = pop_snapshot(session_id)
+        chat = chats[session_id]
+        # The context in the model may already share a longer prefix (e.g. sessions with the same beginning)
+        if snapshot is not None and len(snapshot[0]) > chat.model.longest_token_prefix(chat.model._input_ids, chat.tokens_cache):
+            chat.load_kv_state(*snapshot)
+        active = session_id
+
+    while True:
+        message = requests.get()
+        if message[0] == 'stop':
+            return
+        if message[0] == 'close':
+            chats.pop(message[1], None)
+            pop_snapshot(message[1])
+            if active == message[1]:
+                active = None
+            continue
+
+        _, request_id, session_id, text, history = message
+        cancel = cancel_tokens.pop(request_id)
+        try:
+            chat = chats.get(session_id)
+            if chat is None or history is not None:
+                pop_snapshot(session_id)
+                chat = chats[session_id] = Chat(agent.llm, n_generate=agent.chat.n_generate, temperature=agent.chat.temperature, top_p=agent.chat.top_p, top_k=agent.chat.top_k, repetition=agent.chat.repetition)
+                chat.messages = [msg for msg in agent.chat.messages if msg.agent == Chat.SYSTEM_KEY]
+                chat.messages += [Message(agent=agent_key, content=content) for agent_key, content in history or []]
+                chat.cache_rebuild()
+            switch_to(session_id)
+
+            # Keep only the system prompt when the reply may not fit the context
+            reset = chat.context_available() < chat.n_generate + len(chat.tokenize_text(text)) + 16
+            if reset:
+                chat.reset_chat(keep_system=True)
+
+            chat.send_message(Chat.USER_KEY, text)
+            for chunk in chat.generate_assistant_reply_stepped(cancel=cancel, terminal=False):
+                conn.send(('chunk', request_id, chunk))
+            reply = chat.messages[-1].content if chat.messages[-1].agent == Chat.ASSISTANT_KEY else ''
+            conn.send(('done', request_id, (reply, reset)))
+        except (EOFError, OSError):
+            return
+        except Exception as e:
+            conn.send(('error', request_id, repr(e)))
@@ -0,0 +1,318 @@
+import os
+import re
+import json
+import mmap
+import struct
+from array import array
+from typing import Iterator
+
+from .chat import Chat, Message
+
+SESSIONS_DIR = "./sessions/"
+
+
+class SessionState:
+    def __init__(self) -> None:
+        self.messages: list[Message] = []
+        self.tokens: list[int] = []
+        self.checkpoint: tuple[list[int], bytes] | None = None  # (evaluated tokens, llama.cpp state)
+        self.n_garbage_records = 0  # Records made useless by a reset or by a newer checkpoint
+
+
+class SessionStore:
+    """
+    Durable store of chat sessions: one append-only binary log per session.
+
+    Each log starts with a small header and is followed by records made of a fixed header
+    (kind, metadata length, number of tokens, blob length), JSON metadata, token IDs as
+    int32 and an optional blob, each part padded to 4 bytes so that the tokens of a
+    memory-mapped log can be read without copies. Records are:
+    - MESSAGE: a message of the chat (agent and content)
+    - TOKENS: tokens appended to the context of the chat
+    - CHECKPOINT: the llama.cpp state (KV cache) after evaluating the stored tokens
+    - RESET: everything before this record is discarded
+    """
+
+    MAGIC = b'LLMS'
+    VERSION = 1
+    FILE_HEADER = struct.Struct('<4sHH')
+    RECORD_HEADER = struct.Struct('<BxxxIIQ')
+
+    MESSAGE = 1
+    TOKENS = 2
+    CHECKPOINT = 3
+    RESET = 4
+
+    EXTENSION = '.llms'
+    SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+    def __init__(self, directory: str = SESSIONS_DIR) -> None:
+        """
+        Create a new SessionStore object
+
+        @param directory: the directory that contains the session logs
+        """
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+        # What has already been written for the sessions used by this process: (messages, tokens)
+        self._synced: dict[str, tuple[list[Message], list[int]]] = {}
+        # End offset of the last valid record of each log (anything after it is a truncated write)
+        self._sizes: dict[str, int] = {}
+
+
+    def path(self, session_id: str) -> str:
+        """
+        Get the path of the log of a session
+
+        @param session_id: the session ID (letters, digits, '_', '-' and '.')
+        @return: the path of the log
+        """
+        if not self.SESSION_ID_PATTERN.match(session_id):
+            raise ValueError(f'Invalid session ID: {session_id!r}')
+        return os.path.join(self.directory, session_id + self.EXTENSION)
+
+
+    def exists(self, session_id: str) -> bool:
+        """
+        Check if a session was stored
+
+        @param session_id: the session ID
+        @return: whether or not the session exists
+        """
+        return os.path.exists(self.path(session_id))
+
+
+    def list_sessions(self) -> Iterator[str]:
+        """
+        List the stored sessions without opening their logs
+
+        @return: the session IDs
+        """
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(self.EXTENSION):
+                    yield entry.name[:-len(self.EXTENSION)]
+
+
+    def load(self, session_id: str) -> SessionState:
+        """
+        Read the state of a session by memory-mapping its log
+
+        @param session_id: the session ID
+        @return: the messages, the tokens of the context and the last valid checkpoint
+        """
+        state = SessionState()
+        path = self.path(session_id)
+        if os.path.getsize(path) <= self.FILE_HEADER.size:
+            self._synced[session_id] = ([], [])
+            self._sizes[session_id] = 0
+            return state
+
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, _ = self.FILE_HEADER.unpack_from(mm, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError(f'{path} is not a session log')
+
+            checkpoint = None
+            size = self.FILE_HEADER.size
+            with memoryview(mm) as view:
+                for n_records, (kind, meta, tokens, blob, size) in enumerate(self._records(view), start=1):
+                    if kind == self.RESET:
+                        state = SessionState()
+                        state.n_garbage_records = n_records
+                        checkpoint = None
+                    elif kind == self.MESSAGE:
+                        meta = json.loads(view[meta[0]:meta[1]].tobytes())
+                        state.messages.append(Message(agent=meta['agent'], content=meta['content']))
+                    elif kind == self.TOKENS:
+                        state.tokens += self._read_tokens(view, tokens)
+                    elif kind == self.CHECKPOINT:
+                        # Only the position is kept: older checkpoints are never copied out of the map
+                        state.n_garbage_records += checkpoint is not None
+                        checkpoint = (tokens, blob)
+
+                if checkpoint is not None:
+                    tokens, blob = checkpoint
+                    state.checkpoint = (self._read_tokens(view, tokens), view[blob[0]:blob[1]].tobytes())
+
+        # A checkpoint is valid only if it still evaluates a prefix of the context
+        if state.checkpoint is not None and state.tokens[:len(state.checkpoint[0])] != state.checkpoint[0]:
+            state.checkpoint = None
+            state.n_garbage_records += 1
+
+        self._synced[session_id] = (list(state.messages), list(state.tokens))
+        self._sizes[session_id] = size
+        return state
+
+
+    def sync(self, session_id: str, chat: Chat) -> None:
+        """
+        Append to the log of a session the messages and tokens of a chat that were not stored yet.
+        If the chat was reset (or its context rebuilt) since the last sync, a RESET record is
+        written followed by the whole state.
+
+        @param session_id: the session ID
+        @param chat: the chat of the session
+        """
+        if session_id not in self._synced:
+            if self.exists(session_id):
+                self.load(session_id)
+            else:
+                self._synced[session_id] = ([], [])
+        messages, tokens = self._synced[session_id]
+
+        records = []
+        reset = (
+            len(chat.messages) < len(messages)
+            or any(new is not old for new, old in zip(chat.messages, messages))
+            or chat.tokens_cache[:len(tokens)] != tokens
+        )
+        if reset:
+            records.append(self._record(self.RESET))
+            messages, tokens = [], []
+
+        for message in chat.messages[len(messages):]:
+            records.append(self._record(self.MESSAGE, meta={'agent': message.agent, 'content': message.content}))
+        if len(chat.tokens_cache) > len(tokens):
+            records.append(self._record(self.TOKENS, tokens=chat.tokens_cache[len(tokens):]))
+
+        if records:
+            self._append(session_id, records)
+        self._synced[session_id] = (list(chat.messages), list(chat.tokens_cache))
+
+
+    def checkpoint(self, session_id: str, tokens: list[int], data: bytes) -> None:
+        """
+        Append a KV cache checkpoint to the log of a session
+
+        @param session_id: the session ID
+        @param tokens: the tokens evaluated in the checkpoint
+        @param data: the llama.cpp state
+        """
+        self._append(session_id, [self._record(self.CHECKPOINT, tokens=tokens, blob=data)])
+
+
+    def compact(self, session_id: str) -> None:
+        """
+        Rewrite the log of a session keeping only the current messages, tokens and last valid checkpoint
+
+        @param session_id: the session ID
+        """
+        state = self.load(session_id)
+        records = [self._record(self.MESSAGE, meta={'agent': msg.agent, 'content': msg.content}) for msg in state.messages]
+        if state.tokens:
+            records.append(self._record(self.TOKENS, tokens=state.tokens))
+        if state.checkpoint is not None:
+            records.append(self._record(self.CHECKPOINT, tokens=state.checkpoint[0], blob=state.checkpoint[1]))
+
+        path = self.path(session_id)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.FILE_HEADER.pack(self.MAGIC, self.VERSION, 0))
+            f.writelines(records)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp_path, path)
+
+        self._synced[session_id] = (state.messages, state.tokens)
+        self._sizes[session_id] = size
+
+
+    def delete(self, session_id: str) -> None:
+        """
+        Delete a session
+
+        @param session_id: the session ID
+        """
+        os.remove(self.path(session_id))
+        self._synced.pop(session_id, None)
+        self._sizes.pop(session_id, None)
+
+
+    def _append(self, session_id: str, records: list[bytes]) -> None:
+        """
+        Durably append records to the log of a session, creating it if needed.
+        A truncated record left by a crash is cut off first, so that the new records can be read back.
+
+        @param session_id: the session ID
+        @param records: the encoded records
+        """
+        path = self.path(session_id)
+        if session_id not in self._sizes and os.path.exists(path):
+            self.load(session_id)
+        size = self._sizes.get(session_id, 0)
+
+        with open(path, 'r+b' if size else 'wb') as f:
+            if size:
+                f.truncate(size)
+                f.seek(size)
+            else:
+                f.write(self.FILE_HEADER.pack(self.MAGIC, self.VERSION, 0))
+            f.writelines(records)
+            f.flush()
+            os.fsync(f.fileno())
+            self._sizes[session_id] = f.tell()
+
+
+    def _record(self, kind: int, meta: dict | None = None, tokens: list[int] | None = None, blob: bytes = b'') -> bytes:
+        """
+        Encode a record
+
+        @param kind: the kind of record
+        @param meta: the JSON metadata
+        @param tokens: the token IDs
+        @param blob: the binary payload
+        @return: the encoded record
+        """
+        meta_bytes = json.dumps(meta, ensure_ascii=False).encode('UTF-8') if meta is not None else b''
+        tokens_bytes = array('i', tokens or []).tobytes()
+
+        return b''.join((
+            self.RECORD_HEADER.pack(kind, len(meta_bytes), len(tokens or []), len(blob)),
+            meta_bytes, self._padding(len(meta_bytes)),
+            tokens_bytes,
+            blob, self._padding(len(blob))
+        ))
+
+
+    def _records(self, view: memoryview) -> Iterator[tuple[int, tuple[int, int], tuple[int, int], tuple[int, int], int]]:
+        """
+        Walk the records of a memory-mapped log without copying them.
+        A truncated or unknown last record (e.g. after a crash during a write) and anything after it is ignored.
+
+        @param view: the view of the whole log
+        @return: the kind and the (start, end) offsets of the metadata, tokens and blob of each record,
+            followed by the end offset of the record
+        """
+        offset = self.FILE_HEADER.size
+        while offset + self.RECORD_HEADER.size <= len(view):
+            kind, meta_len, n_tokens, blob_len = self.RECORD_HEADER.unpack_from(view, offset)
+            meta_start = offset + self.RECORD_HEADER.size
+            tokens_start = meta_start + meta_len + len(self._padding(meta_len))
+            blob_start = tokens_start + 4 * n_tokens
+            end = blob_start + blob_len + len(self._padding(blob_len))
+            if kind not in (self.MESSAGE, self.TOKENS, self.CHECKPOINT, self.RESET) or end > len(view):
+                break
+
+            yield kind, (meta_start, meta_start + meta_len), (tokens_start, blob_start), (blob_start, blob_start + blob_len), end
+            offset = end
+
+
+    @staticmethod
+    def _read_tokens(view: memoryview, span: tuple[int, int]) -> list[int]:
+        """
+        Read the token IDs stored at the given offsets of a log
+
+        @param view: the view of the whole log
+        @param span: the (start, end) offsets of the tokens
+        @return: the token IDs
+        """
+        with view[span[0]:span[1]] as raw, raw.cast('i') as tokens:
+            return tokens.tolist()
+
+
+    @staticmethod
+    def _padding(length: int) -> bytes:
+        return b'\0' * (-length % 4)
@@ -0,0 +1,373 @@
+import enum
+import json
+import types
+import typing
+import hashlib
+import functools
+import dataclasses
+from typing import Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from llama_cpp import LlamaGrammar
+
+
+class StructuredOutputError(ValueError):
+    pass
+
+
+# GBNF grammars by schema hash: identically-shaped requests skip the schema conversion
+# (llama.cpp still parses the grammar at the start of every generation)
+_grammar_cache: dict[str, 'LlamaGrammar'] = {}
+
+_JSON_TYPES = {
+    'string': (str,),
+    'integer': (int,),
+    'number': (int, float),
+    'boolean': (bool,),
+    'object': (dict,),
+    'array': (list,),
+    'null': (type(None),)
+}
+
+
+def schema_of(schema: dict | type) -> dict:
+    """
+    Get the JSON schema of a structured output request
+
+    @param schema: a JSON schema or a dataclass
+    @return: the JSON schema
+    """
+    if isinstance(schema, dict):
+        return schema
+    if dataclasses.is_dataclass(schema):
+        return _dataclass_schema(schema)
+    raise TypeError(f'Expected a JSON schema or a dataclass, got {schema!r}')
+
+
+def schema_hash(schema: dict) -> str:
+    """
+    Get a stable hash of a JSON schema (independent from the keys order)
+
+    @param schema: the JSON schema
+    @return: the hex digest of the schema
+    """
+    return hashlib.sha256(json.dumps(schema, sort_keys=True).encode('UTF-8')).hexdigest()
+
+
+def grammar_for(schema: dict | type) -> 'LlamaGrammar':
+    """
+    Get the grammar that constrains the model output to a JSON schema, converting the schema to
+    GBNF only once. A `LlamaGrammar` is just the GBNF text: llama.cpp parses it again for every
+    generation that uses it.
+
+    @param schema: a JSON schema or a dataclass
+    @return: the grammar
+    """
+    json_schema = schema_of(schema)
+    key = schema_hash(json_schema)
+    grammar = _grammar_cache.get(key)
+    if grammar is None:
+        from llama_cpp import LlamaGrammar
+        grammar = LlamaGrammar.from_json_schema(json.dumps(json_schema), verbose=False)
+        _grammar_cache[key] = grammar
+
+    return grammar
+
+
+def validate(value: Any, schema: dict, partial: bool = False) -> str | None:
+    """
+    Check a (possibly partial) value against a JSON schema. Only the subset of JSON schema
+    produced by dataclasses is fully checked: `$ref`, formats and patterns are ignored.
+
+    @param value: the parsed value
+    @param schema: the JSON schema
+    @param partial: if the value is still being generated (missing required keys and string prefixes are accepted)
+    @return: the error message or None if the value is valid
+    """
+    if 'anyOf' in schema or 'oneOf' in schema:
+        options = schema.get('anyOf', schema.get('oneOf'))
+        errors = [validate(value, option, partial) for option in options]
+        return None if None in errors else errors[0]
+
+    if 'const' in schema and not _matches_literal(value, schema['const'], partial):
+        return f'{value!r} is not {schema["const"]!r}'
+    if 'enum' in schema and not any(_matches_literal(value, option, partial) for option in schema['enum']):
+        return f'{value!r} is not one of {schema["enum"]!r}'
+
+    if 'type' in schema:
+        allowed = schema['type'] if isinstance(schema['type'], list) else [schema['type']]
+        if not any(_is_json_type(value, json_type) for json_type in allowed):
+            return f'{value!r} is not of type {schema["type"]}'
+
+    if isinstance(value, dict):
+        properties = schema.get('properties', {})
+        for key, item in value.items():
+            if key in properties:
+                error = validate(item, properties[key], partial)
+                if error: return f'{key}: {error}'
+            elif schema.get('additionalProperties') is False:
+                return f'unexpected property {key!r}'
+        if not partial:
+            missing = [key for key in schema.get('required', []) if key not in value]
+            if missing: return f'missing required properties {missing}'
+
+    if isinstance(value, list) and 'items' in schema:
+        for i, item in enumerate(value):
+            error = validate(item, schema['items'], partial)
+            if error: return f'[{i}]: {error}'
+
+    return None
+
+
+def instantiate(value: Any, schema: dict | type) -> Any:
+    """
+    Convert a parsed JSON value to the requested output type
+
+    @param value: the parsed JSON value
+    @param schema: a JSON schema (the value is returned as is) or a dataclass
+    @return: the value or the dataclass instance
+    """
+    if isinstance(schema, dict):
+        return value
+    return _build(schema, value)
+
+
+class IncrementalJsonParser:
+    """
+    JSON parser fed with chunks of text while they are generated.
+    After each chunk, the longest valid prefix of the document is closed (open strings,
+    objects and arrays) and parsed, so that a partial object is always available.
+    The scanner state is kept between chunks, so each character is scanned only once.
+    """
+
+    def __init__(self) -> None:
+        """
+        Create a new IncrementalJsonParser object
+        """
+        self.text = ''
+        self.value = None
+
+        self._stack: list[list[str]] = []   # [container, expected element] for each open container
+        self._safe_end = 0                  # End of the longest prefix that ends with a complete value or an opening bracket
+        self._safe_closers = ''             # Brackets that close the safe prefix
+        self._in_string = False
+        self._escape = False
+        self._string_is_key = False
+        self._scalar = False
+
+
+    def feed(self, chunk: str) -> Any:
+        """
+        Append a chunk of text to the document
+
+        @param chunk: the new text
+        @return: the partial value parsed until now (None if nothing is parsable yet)
+        """
+        start = len(self.text)
+        self.text += chunk
+        for i in range(start, len(self.text)):
+            self._scan(i)
+
+        for candidate in self._candidates():
+            try:
+                self.value = json.loads(candidate)
+                break
+            except ValueError:
+                continue
+
+        return self.value
+
+
+    def is_complete(self) -> bool:
+        """
+        Check if the text is a complete JSON document
+
+        @return: whether or not the document is complete
+        """
+        return not self._stack and not self._in_string and self._safe_end > 0 and not self.text[self._safe_end:].strip()
+
+
+    def _closers(self) -> str:
+        return ''.join('}' if container == '{' else ']' for container, _ in reversed(self._stack))
+
+
+    def _mark_safe(self, end: int) -> None:
+        self._safe_end = end
+        self._safe_closers = self._closers()
+
+
+    def _value_done(self) -> None:
+        if self._stack: self._stack[-1][1] = 'comma'
+
+
+    def _scan(self, i: int) -> None:
+        """
+        Update the scanner state with a single character
+
+        @param i: the index of the character in the text
+        """
+        char = self.text[i]
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif char == '\\':
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+                if self._string_is_key:
+                    self._stack[-1][1] = 'colon'
+                else:
+                    self._value_done()
+                    self._mark_safe(i + 1)
+            return
+
+        if self._scalar:
+            if char not in ',}] \t\r\n': return
+            self._scalar = False
+            self._value_done()
+            self._mark_safe(i)
+
+        if char in ' \t\r\n':
+            return
+        if char in '{[':
+            self._stack.append([char, 'key' if char == '{' else 'value'])
+            self._mark_safe(i + 1)
+        elif char in '}]':
+            if self._stack: self._stack.pop()
+            self._value_done()
+            self._mark_safe(i + 1)
+        elif char == ':':
+            if self._stack: self._stack[-1][1] = 'value'
+        elif char == ',':
+            if self._stack: self._stack[-1][1] = 'key' if self._stack[-1][0] == '{' else 'value'
+        elif char == '"':
+            self._in_string = True
+            self._string_is_key = bool(self._stack) and self._stack[-1] == ['{', 'key']
+        else:
+            self._scalar = True
+
+
+    def _candidates(self) -> list[str]:
+        """
+        Build the closed documents to try, from the longest to the shortest
+
+        @return: the candidate documents
+        """
+        candidates = []
+        if self._in_string and not self._string_is_key:
+            # Drop an unfinished escape sequence before closing the string
+            text = self.text[:-1] if self._escape else self.text
+            backslash = text.rfind('\\', -6)
+            if backslash >= 0 and text[backslash + 1:backslash + 2] == 'u' and len(text) - backslash < 6:
+                text = text[:backslash]
+            candidates.append(text + '"' + self._closers())
+        elif self._scalar:
+            candidates.append(self.text + self._closers())
+        candidates.append(self.text[:self._safe_end] + self._safe_closers)
+
+        return candidates
+
+
+def _is_json_type(value: Any, json_type: str) -> bool:
+    if isinstance(value, bool) and json_type in ('integer', 'number'):
+        return False
+    return isinstance(value, _JSON_TYPES.get(json_type, (object,)))
+
+
+def _matches_literal(value: Any, literal: Any, partial: bool) -> bool:
+    if partial and isinstance(value, str) and isinstance(literal, str):
+        return literal.startswith(value)
+    return value == literal
+
+
+def type_schema(annotation: Any) -> dict:
+    """
+    Convert a type annotation to a JSON schema
+
+    @param annotation: the type annotation
+    @return: the JSON schema
+    """
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+
+    if origin in (typing.Union, types.UnionType):
+        return {'anyOf': [type_schema(arg) for arg in args]}
+    if origin is typing.Literal:
+        return {'enum': list(args)}
+    if origin in (list, tuple, set, frozenset):
+        return {'type': 'array', 'items': type_schema(args[0])} if args else {'type': 'array'}
+    if origin is dict:
+        return {'type': 'object', 'additionalProperties': type_schema(args[1])} if args else {'type': 'object'}
+    if annotation is type(None):
+        return {'type': 'null'}
+    if annotation is bool:
+        return {'type': 'boolean'}
+    if annotation is int:
+        return {'type': 'integer'}
+    if annotation is float:
+        return {'type': 'number'}
+    if annotation is str:
+        return {'type': 'string'}
+    if isinstance(annotation, type) and issubclass(annotation, enum.Enum):
+        return {'enum': [member.value for member in annotation]}
+    if dataclasses.is_dataclass(annotation):
+        return _dataclass_schema(annotation)
+    if annotation is list:
+        return {'type': 'array'}
+    if annotation is dict:
+        return {'type': 'object'}
+
+    raise TypeError(f'Unsupported type for structured output: {annotation!r}')
+
+
+@functools.cache
+def _dataclass_schema(cls: type) -> dict:
+    """
+    Convert a dataclass to a JSON schema: fields without a default are required
+
+    @param cls: the dataclass
+    @return: the JSON schema
+    """
+    hints = typing.get_type_hints(cls)
+    fields = dataclasses.fields(cls)
+
+    return {
+        'type': 'object',
+        'properties': {field.name: type_schema(hints[field.name]) for field in fields},
+        'required': [
+            field.name for field in fields
+            if field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING
+        ],
+        'additionalProperties': False
+    }
+
+
+def _build(annotation: Any, value: Any) -> Any:
+    """
+    Build the value of a type annotation from a parsed JSON value
+
+    @param annotation: the type annotation
+    @param value: the parsed JSON value
+    @return: the converted value
+    """
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+
+    if dataclasses.is_dataclass(annotation) and isinstance(value, dict):
+        hints = typing.get_type_hints(annotation)
+        return annotation(**{
+            field.name: _build(hints[field.name], value[field.name])
+            for field in dataclasses.fields(annotation) if field.name in value
+        })
+    if isinstance(annotation, type) and issubclass(annotation, enum.Enum):
+        return annotation(value)
+    if origin in (typing.Union, types.UnionType):
+        for arg in args:
+            if validate(value, type_schema(arg)) is None:
+                return _build(arg, value)
+    if origin in (list, tuple, set, frozenset) and args and isinstance(value, list):
+        return origin(_build(args[0], item) for item in value)
+    if origin is dict and args and isinstance(value, dict):
+        return {key: _build(args[1], item) for key, item in value.items()}
+
+    return value
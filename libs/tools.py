@@ -0,0 +1,310 @@
+import re
+import json
+import time
+import inspect
+import threading
+import typing
+from typing import Callable
+from concurrent.futures import CancelledError, Future, TimeoutError as FutureTimeoutError
+
+from .structured import type_schema
+
+
+class ToolError(Exception):
+    pass
+
+
+class Tool:
+    def __init__(
+            self,
+            func: Callable,
+            name: str | None = None,
+            description: str | None = None,
+            parameters: dict | None = None,
+            timeout: float = 30.0,
+            ttl: float = 0.0
+    ) -> None:
+        """
+        Create a new Tool object that the model can call
+
+        @param func: the Python callable, invoked with the arguments chosen by the model as keywords
+        @param name: the name shown to the model (default: the function name)
+        @param description: the description shown to the model (default: the function docstring)
+        @param parameters: the JSON schema of the arguments (default: derived from the type annotations)
+        @param timeout: the maximum number of seconds to wait for the result
+        @param ttl: the number of seconds a result is reused for identical arguments (0 disables the cache)
+        """
+        self.func = func
+        self.name = name or func.__name__
+        self.description = description or inspect.getdoc(func) or ''
+        self.parameters = parameters or self._parameters_schema(func)
+        self.timeout = timeout
+        self.ttl = ttl
+
+
+    def spec(self) -> dict:
+        """
+        Get the description of the tool in the format expected by the chat template
+
+        @return: the function specification
+        """
+        return {
+            'type': 'function',
+            'function': {'name': self.name, 'description': self.description, 'parameters': self.parameters}
+        }
+
+
+    @staticmethod
+    def _parameters_schema(func: Callable) -> dict:
+        """
+        Build the JSON schema of the arguments from the signature of a function:
+        parameters without a default are required, parameters without annotation accept anything.
+
+        @param func: the function
+        @return: the JSON schema of the arguments
+        """
+        hints = typing.get_type_hints(func)
+        parameters = inspect.signature(func).parameters
+
+        return {
+            'type': 'object',
+            'properties': {name: type_schema(hints[name]) if name in hints else {} for name in parameters},
+            'required': [name for name, param in parameters.items() if param.default is inspect.Parameter.empty]
+        }
+
+
+class ToolCall:
+    def __init__(self, name: str, arguments: dict) -> None:
+        self.name = name
+        self.arguments = arguments
+
+    def key(self) -> tuple[str, str]:
+        return self.name, json.dumps(self.arguments, sort_keys=True)
+
+    def __repr__(self) -> str:
+        return f'<tool_call> {self.name}({self.arguments})'
+
+
+class ToolCallDetector:
+    """
+    Detect tool calls in the stream of text generated by the model, in the
+    `<tool_call>{"name": ..., "arguments": {...}}</tool_call>` format used by Qwen models.
+    """
+
+    START_TAG = '<tool_call>'
+    END_TAG = '</tool_call>'
+
+    def __init__(self) -> None:
+        self.text = ''
+        self._scan_from = 0
+
+
+    def feed(self, chunk: str) -> list[ToolCall]:
+        """
+        Append a chunk of generated text
+
+        @param chunk: the new text
+        @return: the tool calls completed by this chunk
+        """
+        self.text += chunk
+        calls = []
+
+        while True:
+            start = self.text.find(self.START_TAG, self._scan_from)
+            if start < 0: break
+            end = self.text.find(self.END_TAG, start)
+            if end < 0: break
+
+            self._scan_from = end + len(self.END_TAG)
+            body = self.text[start + len(self.START_TAG):end]
+            try:
+                call = json.loads(body)
+                arguments = call.get('arguments', {})
+                if isinstance(arguments, str):
+                    arguments = json.loads(arguments)
+                calls.append(ToolCall(call['name'], arguments))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                calls.append(ToolCall('', {'error': f'Malformed tool call: {body.strip()}'}))
+
+        return calls
+
+
+    @classmethod
+    def strip(cls, text: str) -> str:
+        """
+        Remove the tool calls from a generated text
+
+        @param text: the generated text
+        @return: the text without the tool calls
+        """
+        pattern = re.escape(cls.START_TAG) + '.*?' + re.escape(cls.END_TAG)
+        return re.sub(pattern, '', text, flags=re.DOTALL).strip()
+
+
+class ToolRegistry:
+    """
+    Set of tools available to the model. Calls are executed concurrently, each one on its own
+    daemon thread, as soon as they are detected, and their results are cached per (tool, arguments).
+
+    Python threads cannot be stopped: a call that times out keeps running and keeps one of the
+    `max_workers` slots busy until the tool returns (identical calls wait for the same run instead
+    of taking another slot). Tools that can hang (e.g. on network requests) should enforce their
+    own timeouts, otherwise the other calls queue behind them once all the slots are stuck.
+    Being daemon threads, stuck calls never keep the process from exiting.
+    """
+
+    def __init__(self, max_workers: int = 4) -> None:
+        """
+        Create a new ToolRegistry object
+
+        @param max_workers: the maximum number of tools running at the same time (stuck tools included)
+        """
+        self.tools: dict[str, Tool] = {}
+        self.max_workers = max_workers
+
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._cache: dict[tuple[str, str], tuple[float, str]] = {}
+        self._in_flight: dict[tuple[str, str], Future] = {}
+        self._lock = threading.Lock()
+
+
+    def register(self, tool: Tool) -> Tool:
+        """
+        Add a tool to the registry
+
+        @param tool: the tool
+        @return: the tool added
+        """
+        self.tools[tool.name] = tool
+        return tool
+
+
+    def __len__(self) -> int:
+        return len(self.tools)
+
+
+    def system_prompt(self) -> str:
+        """
+        Get the text that describes the tools to the model, to be appended to the system prompt
+
+        @return: the tools description
+        """
+        specs = '\n'.join(json.dumps(tool.spec(), ensure_ascii=False) for tool in self.tools.values())
+        return (
+            '\n\n# Tools\n\n'
+            'You may call one or more functions to assist with the user query.\n\n'
+            'You are provided with function signatures within <tools></tools> XML tags:\n'
+            f'<tools>\n{specs}\n</tools>\n\n'
+            'For each function call, return a json object with function name and arguments within <tool_call></tool_call> XML tags:\n'
+            '<tool_call>\n{"name": <function-name>, "arguments": <args-json-object>}\n</tool_call>'
+        )
+
+
+    def submit(self, call: ToolCall) -> Future:
+        """
+        Start a tool call in background. A cached result or an identical call already
+        running are reused, and a call to an unknown tool fails at once.
+
+        @param call: the tool call
+        @return: the future of the result (as text)
+        """
+        if call.name not in self.tools:  # It must not wait for a slot: there is no timeout to stop waiting
+            future = Future()
+            future.set_exception(ToolError(call.arguments.get('error') or f'Unknown tool {call.name!r}'))
+            return future
+
+        key = call.key()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                future = Future()
+                future.set_result(cached[1])
+                return future
+            if cached is not None:
+                del self._cache[key]
+            if key in self._in_flight:
+                return self._in_flight[key]
+
+            future = Future()
+            self._in_flight[key] = future
+
+        threading.Thread(target=self._run, args=(call, future), name=f'tool-{call.name}', daemon=True).start()
+        return future
+
+
+    def collect(self, calls: list[tuple[ToolCall, Future]]) -> list[str]:
+        """
+        Wait for the results of the tool calls, each one within the timeout of its tool.
+        A call that times out is not stopped (see `ToolRegistry`).
+
+        @param calls: the tool calls with their futures
+        @return: the results (or error descriptions) in the order of the calls
+        """
+        results = []
+        start_time = time.monotonic()
+        for call, future in calls:  # The calls run concurrently: each timeout starts from the same instant
+            tool = self.tools.get(call.name)
+            try:
+                remaining = max(0.0, start_time + tool.timeout - time.monotonic()) if tool else None
+                results.append(future.result(timeout=remaining))
+            except FutureTimeoutError:  # Not the builtin TimeoutError before Python 3.11
+                results.append(f'Error: {call.name} timed out after {tool.timeout:g} seconds')
+            except CancelledError:
+                results.append(f'Error: {call.name} was cancelled')
+            except Exception as e:
+                results.append(f'Error: {e}')
+
+        return results
+
+
+    def shutdown(self) -> None:
+        """
+        Cancel the calls still waiting for a slot, without waiting for the running tools
+        """
+        with self._lock:
+            for future in self._in_flight.values():
+                future.cancel()
+
+
+    def _run(self, call: ToolCall, future: Future) -> None:
+        """
+        Body of the thread of a tool call: wait for a free slot, run the call and set its future
+
+        @param call: the tool call
+        @param future: the future of the result
+        """
+        with self._slots:
+            if not future.set_running_or_notify_cancel():
+                with self._lock:
+                    self._in_flight.pop(call.key(), None)
+                return
+            try:
+                future.set_result(self._execute(call))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+    def _execute(self, call: ToolCall) -> str:
+        """
+        Run a tool call and cache its result
+
+        @param call: the tool call
+        @return: the result as text (JSON for non-string results)
+        """
+        key = call.key()
+        try:
+            tool = self.tools[call.name]
+            result = tool.func(**call.arguments)
+            result = result if isinstance(result, str) else json.dumps(result, ensure_ascii=False, default=str)
+            if tool.ttl > 0:
+                with self._lock:
+                    now = time.monotonic()
+                    # Expired results of other arguments are evicted here, so that the cache does not grow without bound
+                    for expired in [k for k, (expires, _) in self._cache.items() if expires <= now]:
+                        del self._cache[expired]
+                    self._cache[key] = (now + tool.ttl, result)
+
+            return result
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
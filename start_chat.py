@@ -10,8 +10,8 @@ def main():
     # Setta il nome dell'utente
     InputManager.set_name("luke")
 
-    # Crea un'istanza dell'agente
-    agent = Agent(name="Qwen3-4B-Q4_K_M")
+    # Crea un'istanza dell'agente: il modello viene caricato in background mentre l'utente scrive
+    agent = Agent(name="Qwen3-4B-Q4_K_M", background_load=True, prewarm=True)
 
     # Ciclo di conversazione
     agent.start_conversation()
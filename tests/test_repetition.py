@@ -0,0 +1,55 @@
+import random
+
+from libs.repetition import RepetitionDetector
+
+
+def first_detection(detector: RepetitionDetector, tokens: list[int]) -> int | None:
+    detector.reset()
+    for n, token in enumerate(tokens, start=1):
+        if detector.feed(token):
+            return n
+    return None
+
+
+def test_period_loop():
+    detector = RepetitionDetector()
+    n = first_detection(detector, list(range(7)) * 30)
+    assert n == 7 + 32  # The first copy plus `min_length` repeated tokens
+    assert detector.reason == 'period'
+    assert detector.n_detections == 1
+
+
+def test_ngram_loop():
+    # The same phrase with a different token after each copy is not periodic
+    tokens = []
+    for i in range(20):
+        tokens += list(range(100, 120)) + [1000 + i]
+    detector = RepetitionDetector()
+    assert first_detection(detector, tokens) is not None
+    assert detector.reason == 'ngram'
+
+
+def test_no_detection():
+    detector = RepetitionDetector()
+    assert first_detection(detector, list(range(2000))) is None
+    rng = random.Random(0)
+    assert first_detection(detector, [rng.randrange(50) for _ in range(2000)]) is None
+    assert first_detection(detector, [1] * 20 + list(range(100, 200))) is None  # Short runs like '-----' are allowed
+    assert detector.n_detections == 0
+
+
+def test_penalty_tolerance():
+    tokens = list(range(7)) * 30
+    stop = first_detection(RepetitionDetector(), tokens)
+    penalty = RepetitionDetector(action=RepetitionDetector.PENALTY, penalty=5.0)
+    assert first_detection(penalty, tokens) == 7 + 2 * 32
+
+    # Once a loop is long enough, the token that would continue it is penalized
+    penalty.reset()
+    for token in tokens[:stop]:
+        penalty.feed(token)
+    scores = [0.0] * 10
+    penalty.logits_processor([], scores)
+    expected = tokens[stop]
+    assert scores[expected] == -5.0
+    assert all(score == 0.0 for token, score in enumerate(scores) if token != expected)
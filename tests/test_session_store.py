@@ -0,0 +1,34 @@
+from libs.chat import Message
+from libs.session_store import SessionStore
+
+
+class FakeChat:
+    def __init__(self) -> None:
+        self.messages: list[Message] = []
+        self.tokens_cache: list[int] = []
+
+
+def test_append_after_truncated_write(tmp_path):
+    store = SessionStore(str(tmp_path))
+    chat = FakeChat()
+    chat.messages.append(Message('user', 'ciao'))
+    chat.tokens_cache += [1, 2, 3]
+    store.sync('s', chat)
+
+    # Crash in the middle of a write: a partial record is left at the end of the log
+    with open(store.path('s'), 'ab') as f:
+        f.write(b'\x02\0\0\0junk')
+
+    # Resume the session in a new process and add a turn
+    store = SessionStore(str(tmp_path))
+    state = store.load('s')
+    assert state.tokens == [1, 2, 3]
+    chat = FakeChat()
+    chat.messages, chat.tokens_cache = state.messages, state.tokens
+    chat.messages = chat.messages + [Message('assistant', 'ciao!')]
+    chat.tokens_cache = chat.tokens_cache + [4, 5]
+    store.sync('s', chat)
+
+    state = SessionStore(str(tmp_path)).load('s')
+    assert [msg.content for msg in state.messages] == ['ciao', 'ciao!']
+    assert state.tokens == [1, 2, 3, 4, 5]
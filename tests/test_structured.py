@@ -0,0 +1,71 @@
+import dataclasses
+import enum
+
+from libs.structured import IncrementalJsonParser, schema_of, validate, instantiate
+
+
+class Mood(enum.Enum):
+    HAPPY = 'happy'
+    SAD = 'sad'
+
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: int
+
+
+@dataclasses.dataclass
+class Person:
+    name: str
+    mood: Mood
+    points: list[Point]
+    nickname: str | None = None
+
+
+def feed_all(text: str, chunk_size: int = 3) -> tuple[IncrementalJsonParser, list]:
+    parser = IncrementalJsonParser()
+    values = [parser.feed(text[i:i + chunk_size]) for i in range(0, len(text), chunk_size)]
+    return parser, values
+
+
+def test_parser_partial_values():
+    parser = IncrementalJsonParser()
+    assert parser.feed('{"name": "Al') == {'name': 'Al'}
+    assert parser.feed('ice", "tags": [1, 2') == {'name': 'Alice', 'tags': [1, 2]}
+    assert not parser.is_complete()
+    assert parser.feed(']}') == {'name': 'Alice', 'tags': [1, 2]}
+    assert parser.is_complete()
+
+
+def test_parser_ignores_unfinished_key_and_escape():
+    parser = IncrementalJsonParser()
+    assert parser.feed('{"a": 1, "b') == {'a': 1}
+    parser = IncrementalJsonParser()
+    assert parser.feed('{"a": "x\\u00') == {'a': 'x'}
+    assert parser.feed('e9"}') == {'a': 'xé'}
+
+
+def test_parser_any_chunking():
+    text = '{"v": [0, 0, 0], "s": "a, b}", "n": {"m": null}}'
+    for chunk_size in (1, 2, 5, len(text)):
+        parser, values = feed_all(text, chunk_size)
+        assert parser.is_complete()
+        assert values[-1] == {'v': [0, 0, 0], 's': 'a, b}', 'n': {'m': None}}
+
+
+def test_validate_partial():
+    schema = schema_of(Person)
+    assert validate({'name': 'Al'}, schema, partial=True) is None
+    assert validate({'name': 'Al'}, schema) is not None
+    assert validate({'mood': 'ha'}, schema, partial=True) is None
+    assert validate({'mood': 'angry'}, schema, partial=True) is not None
+    assert validate({'points': [{'x': 'one'}]}, schema, partial=True) is not None
+    assert validate({'age': 3}, schema, partial=True) is not None
+
+
+def test_instantiate_dataclass():
+    value = {'name': 'Alice', 'mood': 'happy', 'points': [{'x': 1, 'y': 2}]}
+    assert validate(value, schema_of(Person)) is None
+    assert instantiate(value, Person) == Person('Alice', Mood.HAPPY, [Point(1, 2)])
+    assert instantiate(value, {'type': 'object'}) is value
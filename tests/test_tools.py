@@ -0,0 +1,79 @@
+import threading
+import time
+
+from libs.tools import Tool, ToolCall, ToolCallDetector, ToolRegistry
+
+
+def test_detector_across_chunks():
+    detector = ToolCallDetector()
+    text = 'Ok <tool_call>\n{"name": "add", "arguments": {"x": 1}}\n</tool_call> and <tool_call>{"name": "now", "arguments": "{}"}</tool_call>'
+    calls = []
+    for i in range(0, len(text), 4):
+        calls += detector.feed(text[i:i + 4])
+    assert [(call.name, call.arguments) for call in calls] == [('add', {'x': 1}), ('now', {})]
+
+
+def test_detector_malformed_call():
+    calls = ToolCallDetector().feed('<tool_call>{"name": </tool_call>')
+    assert calls[0].name == '' and 'Malformed' in calls[0].arguments['error']
+
+
+def test_strip():
+    assert ToolCallDetector.strip('Ecco <tool_call>{"name": "a"}</tool_call>') == 'Ecco'
+
+
+def test_in_flight_dedup():
+    release = threading.Event()
+    runs = []
+
+    def slow(x: int) -> int:
+        runs.append(x)
+        release.wait(5)
+        return x
+
+    registry = ToolRegistry()
+    registry.register(Tool(slow))
+    first = registry.submit(ToolCall('slow', {'x': 1}))
+    second = registry.submit(ToolCall('slow', {'x': 1}))
+    assert first is second
+    release.set()
+    assert registry.collect([(ToolCall('slow', {'x': 1}), first)]) == ['1']
+    assert runs == [1]
+
+
+def test_ttl_expiry():
+    runs = []
+
+    def add(x: int) -> int:
+        runs.append(x)
+        return x + 1
+
+    registry = ToolRegistry()
+    registry.register(Tool(add, ttl=0.05))
+    for x in (1, 1, 2):
+        call = ToolCall('add', {'x': x})
+        registry.collect([(call, registry.submit(call))])
+    assert runs == [1, 2]
+
+    time.sleep(0.1)
+    call = ToolCall('add', {'x': 1})
+    assert registry.collect([(call, registry.submit(call))]) == ['2']
+    assert runs == [1, 2, 1]
+    assert list(registry._cache) == [call.key()]  # The expired result of x=2 was evicted
+
+
+def test_timeout_and_errors():
+    registry = ToolRegistry(max_workers=1)
+    registry.register(Tool(lambda: time.sleep(30), name='hang', timeout=0.1))
+    registry.register(Tool(lambda: 'ok', name='fast'))
+    calls = [ToolCall('hang', {}), ToolCall('missing', {})]
+    start_time = time.monotonic()
+    results = registry.collect([(call, registry.submit(call)) for call in calls])
+    assert time.monotonic() - start_time < 5
+    assert results == ['Error: hang timed out after 0.1 seconds', "Error: Unknown tool 'missing'"]
+
+    # The stuck tool keeps the only slot: waiting calls are cancelled by the shutdown
+    call = ToolCall('fast', {})
+    future = registry.submit(call)
+    registry.shutdown()
+    assert registry.collect([(call, future)]) == ['Error: fast was cancelled']